@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+'''SQLite index of files delivered by the SCGPM bcl2fastq app.
+
+The app adds every file it uploads, with its properties & tags, and uploads
+the index as "<run_name>_L<lane_index>.files.sqlite" in the "miscellany"
+folder. This module only needs the Python standard library, so downstream
+workflows can query a downloaded index without DNAnexus tools:
+
+    from scgpm_file_index import DeliveredFileIndex
+
+    index = DeliveredFileIndex('RunX_L1.files.sqlite')
+    for delivered_file in index.find_files(
+                                           properties = {'file_type': 'fastq', 'read_index': '1'},
+                                           name_pattern = '*.fastq.gz'):
+        print delivered_file['dxid'], index.get_properties(delivered_file['dxid'])
+
+or from the command line:
+
+    $ python scgpm_file_index.py RunX_L1.files.sqlite -p file_type=fastq -p read_index=1
+
+Schema:
+
+    files (dxid TEXT PRIMARY KEY, project TEXT, folder TEXT, name TEXT)
+    properties (dxid TEXT, key TEXT, value TEXT, PRIMARY KEY (dxid, key))
+    tags (dxid TEXT, tag TEXT, PRIMARY KEY (dxid, tag))
+
+'''
+
+__author__ = 'pbilling@stanford.edu (Paul Billing-Ross)'
+
+import sys
+import json
+import sqlite3
+import argparse
+
+class DeliveredFileIndex:
+    '''SQLite index of delivered files with their properties & tags.
+
+    Files are added as they are uploaded, and each addition is committed
+    immediately. Once the index is uploaded, downstream workflows can look up
+    files locally, without paging through platform metadata searches.
+
+    Args:
+        db_file (str): Path of SQLite database; created if it does not exist.
+
+    Attributes:
+        db_file (str): Path of SQLite database.
+        connection (sqlite3.Connection): Open database connection.
+
+    '''
+
+    SCHEMA = (
+              'CREATE TABLE IF NOT EXISTS files ('
+              '    dxid TEXT PRIMARY KEY, project TEXT, folder TEXT, name TEXT)',
+              'CREATE TABLE IF NOT EXISTS properties ('
+              '    dxid TEXT, key TEXT, value TEXT, PRIMARY KEY (dxid, key))',
+              'CREATE TABLE IF NOT EXISTS tags ('
+              '    dxid TEXT, tag TEXT, PRIMARY KEY (dxid, tag))',
+              'CREATE INDEX IF NOT EXISTS properties_key_value ON properties (key, value)',
+              'CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag)')
+
+    def __init__(self, db_file):
+
+        self.db_file = db_file
+        self.connection = sqlite3.connect(db_file)
+        with self.connection:
+            for statement in self.SCHEMA:
+                self.connection.execute(statement)
+
+    def add_file(self, dxid, project, folder, name, properties, tags):
+        '''Add or replace a delivered file.
+
+        Args:
+            dxid (str): DNAnexus ID of file.
+            project (str): ID of project file was uploaded to.
+            folder (str): Folder path of file.
+            name (str): Name of file.
+            properties (dict): Properties with string values.
+            tags (list): List of descriptive tags.
+
+        '''
+
+        with self.connection:
+            self.connection.execute(
+                                    'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                                    (dxid, project, folder, name))
+            self.connection.execute('DELETE FROM properties WHERE dxid = ?', (dxid,))
+            self.connection.execute('DELETE FROM tags WHERE dxid = ?', (dxid,))
+            self.connection.executemany(
+                                        'INSERT INTO properties VALUES (?, ?, ?)',
+                                        [(dxid, key, value) for key, value in properties.items()])
+            self.connection.executemany(
+                                        'INSERT INTO tags VALUES (?, ?)',
+                                        [(dxid, tag) for tag in set(tags or [])])
+
+    def add_tags(self, dxid, tags):
+        '''Add tags to a file already in the index; other files are ignored.
+
+        Args:
+            dxid (str): DNAnexus ID of file.
+            tags (list): Tags to add.
+
+        '''
+
+        with self.connection:
+            self.connection.executemany(
+                                        'INSERT OR IGNORE INTO tags SELECT dxid, ? FROM files WHERE dxid = ?',
+                                        [(tag, dxid) for tag in set(tags)])
+
+    def set_properties(self, dxid, properties):
+        '''Set properties of a file already in the index; other files are ignored.
+
+        Args:
+            dxid (str): DNAnexus ID of file.
+            properties (dict): Properties with string values to add or replace.
+
+        '''
+
+        with self.connection:
+            self.connection.executemany(
+                                        'INSERT OR REPLACE INTO properties SELECT dxid, ?, ? FROM files WHERE dxid = ?',
+                                        [(key, value, dxid) for key, value in properties.items()])
+
+    def add_index(self, db_file):
+        '''Add all files of another index, with their properties & tags.
+
+        Args:
+            db_file (str): Path of SQLite database of the other index.
+
+        '''
+
+        other_index = DeliveredFileIndex(db_file)
+        for delivered_file in other_index.find_files():
+            self.add_file(
+                          properties = other_index.get_properties(delivered_file['dxid']),
+                          tags = other_index.get_tags(delivered_file['dxid']),
+                          **delivered_file)
+        other_index.close()
+
+    def find_files(self, properties=None, tags=None, name_pattern=None):
+        '''Find delivered files matching all given properties & tags.
+
+        Args:
+            properties (dict): Property values files must have.
+            tags (list): Tags files must have.
+            name_pattern (str): Unix shell-style pattern file names must match.
+
+        Returns:
+            list: Dictionaries with dxid, project, folder & name of files.
+
+        '''
+
+        query = 'SELECT dxid, project, folder, name FROM files WHERE 1'
+        parameters = []
+        for key, value in (properties or {}).items():
+            query += (' AND EXISTS (SELECT 1 FROM properties WHERE properties.dxid = files.dxid'
+                      ' AND key = ? AND value = ?)')
+            parameters.extend([key, str(value)])
+        for tag in tags or []:
+            query += ' AND EXISTS (SELECT 1 FROM tags WHERE tags.dxid = files.dxid AND tag = ?)'
+            parameters.append(tag)
+        if name_pattern:
+            query += ' AND name GLOB ?'
+            parameters.append(name_pattern)
+        query += ' ORDER BY name'
+
+        columns = ('dxid', 'project', 'folder', 'name')
+        return [
+                dict(zip(columns, row))
+                for row in self.connection.execute(query, parameters)
+               ]
+
+    def get_properties(self, dxid):
+        '''Get properties of a delivered file.
+
+        Args:
+            dxid (str): DNAnexus ID of file.
+
+        Returns:
+            dict: Property names & values.
+
+        '''
+
+        return dict(self.connection.execute(
+                                            'SELECT key, value FROM properties WHERE dxid = ?',
+                                            (dxid,)))
+
+    def get_tags(self, dxid):
+        '''Get tags of a delivered file.
+
+        Args:
+            dxid (str): DNAnexus ID of file.
+
+        Returns:
+            list: Tags of file.
+
+        '''
+
+        return sorted(row[0] for row in self.connection.execute(
+                                                                'SELECT tag FROM tags WHERE dxid = ?',
+                                                                (dxid,)))
+
+    def close(self):
+        '''Close database connection.'''
+
+        self.connection.close()
+
+def parse_args(args):
+    '''Parse command line arguments.
+
+    Args:
+        args (list): Command line arguments, without program name.
+
+    Returns:
+        argparse.Namespace: Parsed arguments.
+
+    '''
+
+    parser = argparse.ArgumentParser(
+                                     description = 'Find files in an index of files ' +
+                                                   'delivered by the SCGPM bcl2fastq app.')
+    parser.add_argument('db_file', help='SQLite file index, i.e. RunX_L1.files.sqlite')
+    parser.add_argument(
+                        '-p', '--property',
+                        dest = 'properties',
+                        action = 'append',
+                        default = [],
+                        help = 'key=value property files must have; may be repeated')
+    parser.add_argument(
+                        '-t', '--tag',
+                        dest = 'tags',
+                        action = 'append',
+                        default = [],
+                        help = 'Tag files must have; may be repeated')
+    parser.add_argument(
+                        '-n', '--name',
+                        dest = 'name_pattern',
+                        help = "Shell-style pattern of file names, i.e. '*_1.fastq.gz'")
+    return parser.parse_args(args)
+
+def main(args):
+    '''Print matching files as JSON lines with their properties & tags.'''
+
+    parsed_args = parse_args(args)
+    properties = dict(
+                      prop.split('=', 1)
+                      for prop in parsed_args.properties)
+    index = DeliveredFileIndex(parsed_args.db_file)
+    for delivered_file in index.find_files(
+                                           properties = properties,
+                                           tags = parsed_args.tags,
+                                           name_pattern = parsed_args.name_pattern):
+        delivered_file['properties'] = index.get_properties(delivered_file['dxid'])
+        delivered_file['tags'] = index.get_tags(delivered_file['dxid'])
+        print json.dumps(delivered_file, sort_keys=True)
+    index.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
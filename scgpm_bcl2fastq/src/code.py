@@ -10,19 +10,90 @@ import re
 import ast
 import sys
 import dxpy
+import zlib
+import gzip
 import glob
 import time
 import json
 import shutil
+import string
+import struct
+import hashlib
 import fnmatch
+import itertools
+import logging
 import datetime
+import threading
+import functools
 import subprocess
+import collections
+import multiprocessing
 
 from xml.etree import ElementTree
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
+
+# Installed from resources/usr/local/lib/python2.7/dist-packages
+from scgpm_file_index import DeliveredFileIndex
 
 LOCAL_OUTPUT = 'output'
 PROJECT_DXID = dxpy.PROJECT_CONTEXT_ID
 
+# Number of trailing bcl2fastq output lines kept for error reports.
+BCL2FASTQ_TAIL_LINES = 200
+# Number of seconds between bcl2fastq progress log events.
+PROGRESS_INTERVAL = 60
+# Size of chunks read from local fastqs while streaming them to DNAnexus.
+UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+# Number of parallel connections used to download input archives.
+DOWNLOAD_CONNECTIONS = 8
+# Number of passes over failed parts before a download is abandoned.
+DOWNLOAD_ATTEMPTS = 3
+# Maximum size of a single ranged request while downloading.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024 * 1024
+# Lifetime of download URLs, in seconds.
+DOWNLOAD_URL_DURATION = 7 * 24 * 60 * 60
+# Output directory of bcl2fastq2 smoke test runs.
+SMOKE_OUTPUT = 'smoke_output'
+# Compression level of fastqs rewritten by the applet.
+FASTQ_COMPRESSION_LEVEL = 4
+# Local SQLite index of files delivered by the applet.
+FILE_INDEX_DB = 'bcl2fastq_files.sqlite'
+# Output directory of fastqs regenerated from undemultiplexed reads.
+REDEMUX_OUTPUT = 'redemux_output'
+# First bcl2fastq2 version that writes UMI cycles ("U" in bases mask) to read names.
+BCL2FASTQ_UMI_VERSION = (2, 20)
+# Seconds to wait for more output of fastqs bcl2fastq2 is still writing.
+FOLLOW_POLL_INTERVAL = 5
+# Bytes read at a time from fastqs bcl2fastq2 is still writing.
+FOLLOW_CHUNK_SIZE = 1024 * 1024
+# Fraction of smoke test unknown barcode reads a barcode diagnosis must explain.
+SMOKE_DIAGNOSIS_FRACTION = 0.5
+# Fraction of smoke test unknown barcode reads checked for shared index cycles.
+SMOKE_COMMON_FRACTION = 0.9
+# Fewest distinct unknown barcodes needed to spot cycles shared by all of them.
+SMOKE_MIN_DISTINCT_BARCODES = 4
+# Translation table for complementing DNA sequences.
+COMPLEMENT_TABLE = string.maketrans('ACGTN', 'TGCAN')
+# Quality score bins as (lowest score, highest score, binned score).
+QUALITY_BINNING_SCHEMES = {
+                           # HiSeq X/4000 & MiSeq RTA 8-level binning
+                           'illumina8': [
+                                         (2, 9, 6),
+                                         (10, 19, 15),
+                                         (20, 24, 22),
+                                         (25, 29, 27),
+                                         (30, 34, 33),
+                                         (35, 39, 37),
+                                         (40, 93, 40)],
+                           # NovaSeq RTA3 4-level binning
+                           'illumina4': [
+                                         (0, 2, 2),
+                                         (3, 14, 12),
+                                         (15, 30, 23),
+                                         (31, 93, 37)]
+                          }
+
 def parse_applet_inputs(applet_inputs):
     '''Parse applet arguments into functional categories.
 
@@ -40,14 +111,21 @@ def parse_applet_inputs(applet_inputs):
                    'project_folder',
                    'lane_data_tar',
                    'metadata_tar',
-                   'barcodes_file')
+                   'barcodes_file',
+                   'smoke_test',
+                   'smoke_test_tiles',
+                   'smoke_test_max_undetermined',
+                   'quality_binning',
+                   'keep_undemultiplexed',
+                   'undemultiplexed_file')
     
     # Sequencing library information & added to file properties.
     sample_keys = (
                    'run_name', 
                    'lane_index',
                    'library_name',
-                   'project_name') 
+                   'project_name',
+                   'read_structure') 
     
     # Arguments passed to bcl2fastq2 executable & added to file properties.
     options_values = (
@@ -97,16 +175,31 @@ def parse_applet_inputs(applet_inputs):
                        'in sample_args')
         sample_args.update(applet_inputs['properties'])
 
+    # "none" disables quality binning
+    if applet_args.get('quality_binning') == 'none':
+        del applet_args['quality_binning']
+
     options_dict['output_dir'] = LOCAL_OUTPUT
     applet_args['project_dxid'] = PROJECT_DXID
 
     return applet_args, sample_args, options_dict, flags_dict, tags
 
-def download_file(file_dxid):
+def download_file(file_dxid, connections=DOWNLOAD_CONNECTIONS, attempts=DOWNLOAD_ATTEMPTS):
     '''Download file from DX Object store
 
+    The file is fetched as byte ranges over several connections and written
+    into a preallocated sparse file. Ranges follow the parts the file was 
+    uploaded in, so each one is checked against the MD5 recorded by the 
+    platform before it is marked complete. Completed parts are recorded in 
+    "<filename>.parts", which starts with the file ID. If any range fails,
+    the parts missing from the journal are fetched again, up to 'attempts'
+    times. A journal left by an earlier call is only resumed if it belongs
+    to the same file, and the parts it lists are re-hashed from disk first.
+
     Args: 
         file_dxid (str): DNAnexus ID of file to be downloaded.
+        connections (int): Number of parallel connections.
+        attempts (int): Number of passes over the parts still missing.
     
     Returns: 
         str: Path to downloaded file.
@@ -114,10 +207,232 @@ def download_file(file_dxid):
     '''
 
     dx_file = dxpy.DXFile(file_dxid)
-    filename = dx_file.describe()['name']
-    dxpy.download_dxfile(dxid=dx_file.get_id(), filename=filename)
+    description = dx_file.describe(fields={'name', 'size', 'parts'})
+    filename = description['name']
+    file_size = description['size']
+    byte_ranges = get_download_ranges(description)
+    journal_file = '{}.parts'.format(filename)
+
+    completed = _resume_download(file_dxid, filename, file_size, byte_ranges, journal_file)
+    if completed is None:
+        # Preallocate sparse file so ranges can be written in any order
+        with open(filename, 'wb') as LOCAL:
+            LOCAL.truncate(file_size)
+        with open(journal_file, 'w') as JOURNAL:
+            JOURNAL.write('{}\n'.format(file_dxid))
+        completed = set()
+
+    url, headers = dx_file.get_download_url(
+                                            duration = DOWNLOAD_URL_DURATION,
+                                            preauthenticated = True)
+    download_range = functools.partial(
+                                       _download_range,
+                                       url = url,
+                                       headers = headers,
+                                       filename = filename,
+                                       journal_file = journal_file,
+                                       journal_lock = threading.Lock())
+    for attempt in range(1, attempts + 1):
+        pending = [
+                   byte_range for byte_range in byte_ranges 
+                   if byte_range['name'] not in completed
+                  ]
+        if not pending:
+            break
+        pool = ThreadPool(min(connections, len(pending)))
+        try:
+            pool.map(download_range, pending)
+        except Exception as error:
+            logger.warning('Download attempt {} of {} failed: {}'.format(
+                                                                         attempt,
+                                                                         filename,
+                                                                         error))
+        finally:
+            # Let ranges already in flight finish & reach the journal
+            pool.close()
+            pool.join()
+        completed = _read_download_journal(journal_file)[1]
+
+    # Every part must have been written & matched its platform MD5
+    missing = [
+               byte_range['name'] for byte_range in byte_ranges 
+               if byte_range['name'] not in completed
+              ]
+    if missing:
+        raise Exception('Parts {} of {} were not verified after {} attempts'.format(
+                                                                                   missing,
+                                                                                   filename,
+                                                                                   attempts))
+    os.remove(journal_file)
     return filename
 
+def _read_download_journal(journal_file):
+    '''Read a download journal.
+
+    Args:
+        journal_file (str): Journal written by download_file().
+
+    Returns:
+        tuple: DNAnexus ID of the file & set of names of completed parts.
+
+    '''
+
+    with open(journal_file, 'r') as JOURNAL:
+        lines = [line.strip() for line in JOURNAL if line.strip()]
+    if not lines:
+        return None, set()
+    return lines[0], set(lines[1:])
+
+def _resume_download(file_dxid, filename, file_size, byte_ranges, journal_file):
+    '''Check which parts of an interrupted download can be kept.
+
+    Parts listed in the journal are re-hashed from the local file, since
+    the file may have changed since they were recorded. Parts that no
+    longer match their platform MD5 are dropped from the journal.
+
+    Args:
+        file_dxid (str): DNAnexus ID of file being downloaded.
+        filename (str): Local file the download writes to.
+        file_size (int): Size of file on DNAnexus, in bytes.
+        byte_ranges (list): Byte ranges from get_download_ranges().
+        journal_file (str): Journal of completed parts.
+
+    Returns:
+        set: Names of verified parts; None if the download can't be resumed.
+
+    '''
+
+    if not (os.path.exists(filename) and os.path.exists(journal_file)):
+        return None
+    journal_dxid, journaled = _read_download_journal(journal_file)
+    if journal_dxid != file_dxid or os.path.getsize(filename) != file_size:
+        logger.warning('{} belongs to a different download; starting over'.format(
+                                                                                  journal_file))
+        return None
+
+    completed = set()
+    with open(filename, 'rb') as LOCAL:
+        for byte_range in byte_ranges:
+            if byte_range['name'] not in journaled:
+                continue
+            md5 = hashlib.md5()
+            LOCAL.seek(byte_range['start'])
+            remaining = byte_range['size']
+            while remaining:
+                data = LOCAL.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+                if not data:
+                    break
+                md5.update(data)
+                remaining -= len(data)
+            if not remaining and md5.hexdigest() == byte_range['md5']:
+                completed.add(byte_range['name'])
+
+    with open(journal_file, 'w') as JOURNAL:
+        JOURNAL.write('{}\n'.format(file_dxid))
+        for name in sorted(completed, key=int):
+            JOURNAL.write('{}\n'.format(name))
+    logger.info('Resuming download of {}: {} of {} parts complete'.format(
+                                                                          filename,
+                                                                          len(completed),
+                                                                          len(byte_ranges)))
+    return completed
+
+def get_download_ranges(description):
+    '''Get byte ranges to download a DNAnexus file in.
+
+    Ranges are the parts the file was uploaded in, each with the MD5 the 
+    platform recorded for it. Files without complete part MD5s cannot be
+    verified, so they are rejected before anything is downloaded.
+
+    Args:
+        description (dict): File description with "size" & "parts" fields.
+
+    Returns:
+        list: Dictionaries with name, start, size and md5 of each byte range,
+              in file order.
+
+    '''
+
+    byte_ranges = []
+    start = 0
+    parts = description.get('parts') or {}
+    for index in sorted(parts.keys(), key=int):
+        part = parts[index]
+        if not part.get('md5'):
+            raise Exception('Part {} of {} has no platform MD5; '.format(
+                                                                     index, 
+                                                                     description['name']) +
+                            'download cannot be verified')
+        byte_ranges.append({
+                            'name': index,
+                            'start': start,
+                            'size': part['size'],
+                            'md5': part['md5']
+                           })
+        start += part['size']
+
+    if start != description['size']:
+        raise Exception('Parts of {} add up to {} bytes; file has {}. '.format(
+                                                                          description['name'],
+                                                                          start,
+                                                                          description['size']) +
+                        'Download cannot be verified')
+    return byte_ranges
+
+def _download_range(byte_range, url, headers, filename, journal_file, journal_lock):
+    '''Download one byte range of a file & record it as complete.
+
+    Args:
+        byte_range (dict): Name, start, size and md5 of the range.
+        url (str): Preauthenticated download URL of the file.
+        headers (dict): HTTP headers to send with requests.
+        filename (str): Local preallocated file to write the range into.
+        journal_file (str): File ID followed by names of completed ranges.
+        journal_lock (threading.Lock): Serializes writes to the journal.
+
+    '''
+
+    md5 = hashlib.md5()
+    end = byte_range['start'] + byte_range['size']
+    with open(filename, 'r+b') as LOCAL:
+        offset = byte_range['start']
+        while offset < end:
+            request_end = min(offset + DOWNLOAD_CHUNK_SIZE, end)
+            request_headers = dict(headers)
+            request_headers['Range'] = 'bytes={}-{}'.format(offset, request_end - 1)
+            data = dxpy.DXHTTPRequest(
+                                      url, 
+                                      '', 
+                                      method = 'GET',
+                                      headers = request_headers,
+                                      auth = None,
+                                      jsonify_data = False,
+                                      prepend_srv = False,
+                                      always_retry = True,
+                                      decode_response_body = False)
+            if len(data) != request_end - offset:
+                raise Exception('Range {}-{} of {} returned {} bytes'.format(
+                                                                              offset,
+                                                                              request_end - 1,
+                                                                              filename,
+                                                                              len(data)))
+            LOCAL.seek(offset)
+            LOCAL.write(data)
+            md5.update(data)
+            offset = request_end
+        LOCAL.flush()
+        os.fsync(LOCAL.fileno())
+
+    if md5.hexdigest() != byte_range['md5']:
+        raise Exception('Part {} of {} does not match platform MD5'.format(
+                                                                           byte_range['name'],
+                                                                           filename))
+    with journal_lock:
+        with open(journal_file, 'a') as JOURNAL:
+            JOURNAL.write('{}\n'.format(byte_range['name']))
+            JOURNAL.flush()
+            os.fsync(JOURNAL.fileno())
+
 def untar_file(filename):
     '''Extract tar archive.
 
@@ -172,6 +487,129 @@ def truncate_flowcell_id(flowcell_id):
         trunc_flowcell_id = elements[0][:5]
     return trunc_flowcell_id
 
+def get_lane_tiles(run_info_file, lane_index):
+    '''Get names of all tiles imaged on a flowcell lane.
+
+    Newer RunInfo.xml files list every tile explicitly ("1_1101"). For older
+    files the tile names are built from the FlowcellLayout dimensions:
+    surface, swath, (section,) and tile number.
+
+    Args:
+        run_info_file (str): Filename of RunInfo.xml file ("RunInfo.xml").
+        lane_index (int): Index of Illumina flowcell lane (1-8).
+
+    Returns:
+        list: Tile names ordered by surface, swath and tile; i.e. "1101".
+
+    '''
+
+    tree = ElementTree.parse(run_info_file)
+    layout = tree.find('.//FlowcellLayout')
+    if layout is None:
+        logger.warning('No FlowcellLayout in {}'.format(run_info_file))
+        return []
+
+    tile_elements = layout.findall('.//Tiles/Tile')
+    if tile_elements:
+        tiles = []
+        for tile_element in tile_elements:
+            lane, tile = tile_element.text.strip().split('_')
+            if int(lane) == int(lane_index):
+                tiles.append(tile)
+        return sorted(tiles)
+
+    surface_count = int(layout.get('SurfaceCount'))
+    swath_count = int(layout.get('SwathCount'))
+    tile_count = int(layout.get('TileCount'))
+    section_count = layout.get('SectionPerLane')
+    tiles = []
+    for surface in range(1, surface_count + 1):
+        for swath in range(1, swath_count + 1):
+            if section_count:
+                # FiveDigit naming (NextSeq): surface, swath, section, tile
+                for section in range(1, int(section_count) + 1):
+                    for tile in range(1, tile_count + 1):
+                        tiles.append('{}{}{}{:02d}'.format(
+                                                           surface,
+                                                           swath,
+                                                           section,
+                                                           tile))
+            else:
+                for tile in range(1, tile_count + 1):
+                    tiles.append('{}{}{:02d}'.format(surface, swath, tile))
+    return tiles
+
+def get_bcl2fastq_version():
+    '''Get version of the installed bcl2fastq2.
+
+    Returns:
+        tuple: Version numbers, i.e. (2, 20, 0, 422); None if bcl2fastq2 
+               did not report a version.
+
+    '''
+
+    try:
+        stdout, stderr = create_subprocess('bcl2fastq --version', pipeStdout=True)
+    except Exception as error:
+        logger.warning('Could not get bcl2fastq2 version: {}'.format(error))
+        return None
+    match = re.search(r'bcl2fastq v(\d+(?:\.\d+)*)', stdout + stderr)
+    if not match:
+        logger.warning('Could not parse bcl2fastq2 version: {}'.format(stderr))
+        return None
+    return tuple(int(number) for number in match.group(1).split('.'))
+
+def get_sample_sheet_ids(sample_sheet):
+    '''Get sample IDs of a sample sheet in the order bcl2fastq2 numbers them.
+
+    Args:
+        sample_sheet (str): Path of CSV sample sheet.
+
+    Returns:
+        list: Unique sample IDs; the first is sample number 1 ("_S1_").
+
+    '''
+
+    sample_ids = []
+    with open(sample_sheet, 'r') as SHEET:
+        in_data = False
+        columns = None
+        for line in SHEET:
+            line = line.strip()
+            if line.startswith('['):
+                in_data = (line == '[Data]')
+                continue
+            if not in_data or not line:
+                continue
+            values = line.split(',')
+            if columns is None:
+                columns = values
+                continue
+            sample_id = values[columns.index('Sample_ID')]
+            if sample_id not in sample_ids:
+                sample_ids.append(sample_id)
+    return sample_ids
+
+def get_fastq_prefix(output_dir, sample_id, sample_number, lane_index):
+    '''Get bcl2fastq2-style fastq path prefix of a sample.
+
+    Args:
+        output_dir (str): bcl2fastq2 output directory.
+        sample_id (str): Sample ID from the sample sheet.
+        sample_number (int): Position of sample in sheet; 0 for Undetermined.
+        lane_index (int): Index of Illumina flowcell lane (1-8).
+
+    Returns:
+        str: Path up to "_R1_001.fastq.gz"; i.e. "output/SampleA_S1_L001".
+
+    '''
+
+    # Dual barcode sample IDs become "<i7>_<i5>" as in bcl2fastq2 names
+    return os.path.join(output_dir, '{}_S{}_L{:03d}'.format(
+                                                           sample_id.replace('-', '_'),
+                                                           sample_number,
+                                                           int(lane_index)))
+
 def configure_logger(name, file_handle=False):
     '''Configure logger object.
     
@@ -239,6 +677,52 @@ def create_subprocess(cmd, pipeStdout=False, checkRetcode=True):
     else:
         return popen
 
+def stream_subprocess(cmd, line_handler=None, tail_lines=BCL2FASTQ_TAIL_LINES):
+    '''Run a subprocess and stream its output into the log line by line.
+
+    Stdout and stderr of the subprocess are merged and read as they are
+    written, so memory use does not grow with the length of the run. Only
+    the last 'tail_lines' lines are kept, and reported if the command fails.
+    If reading stops early, i.e. because 'line_handler' raised, the
+    subprocess is killed & reaped before the exception propagates.
+
+    Args:
+        cmd (str): The command line for the subprocess.
+        line_handler (function): Optional; called with every output line.
+        tail_lines (int): Number of trailing output lines to keep.
+
+    Returns:
+        list: The last 'tail_lines' lines of output.
+
+    '''
+
+    tail = collections.deque(maxlen=tail_lines)
+    popen = subprocess.Popen(
+                             cmd,
+                             shell=True,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT,
+                             bufsize=1)
+    try:
+        for line in iter(popen.stdout.readline, ''):
+            line = line.rstrip()
+            tail.append(line)
+            logger.debug(line)
+            if line_handler:
+                line_handler(line)
+    except:
+        # Reading stopped early; don't leave the command running
+        if popen.poll() is None:
+            logger.warning('Killing subprocess command: {}'.format(cmd))
+            popen.kill()
+        raise
+    finally:
+        popen.stdout.close()
+        retcode = popen.wait()
+    if retcode:
+        raise Exception("subprocess command '{cmd}' failed with returncode '{returncode}'.\n\nLast {n} lines of output: '{tail}'.".format(cmd=cmd,returncode=retcode,n=len(tail),tail='\n'.join(tail)))
+    return list(tail)
+
 def format_library_name(library_name):
     '''Remove datestamp from library name
 
@@ -256,6 +740,400 @@ def format_library_name(library_name):
     formatted_name = re.sub(r"[^a-zA-Z0-9]+", "-", stripped_name)
     return formatted_name
 
+class PigzFile:
+    '''File-like pipe to a pigz process reading or writing a gzipped file.
+
+    pigz decompresses in a separate thread & compresses with all cores, which
+    keeps fastq rewriting from being limited by single-threaded gzip.
+
+    Args:
+        filename (str): Path of gzipped file.
+        mode (str): "r" to decompress the file, "w" to compress into it.
+
+    '''
+
+    def __init__(self, filename, mode='r'):
+
+        self.filename = filename
+        self.mode = mode
+        if mode == 'r':
+            self._popen = subprocess.Popen(
+                                           ['pigz', '-dc', filename],
+                                           stdout = subprocess.PIPE,
+                                           bufsize = -1)
+            self._file = self._popen.stdout
+        else:
+            self._output = open(filename, 'wb')
+            self._popen = subprocess.Popen(
+                                           ['pigz', '-c', '-{}'.format(FASTQ_COMPRESSION_LEVEL)],
+                                           stdin = subprocess.PIPE,
+                                           stdout = self._output,
+                                           bufsize = -1)
+            self._file = self._popen.stdin
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def readline(self):
+        return self._file.readline()
+
+    def write(self, data):
+        self._file.write(data)
+
+    def close(self):
+        self._file.close()
+        retcode = self._popen.wait()
+        if self.mode != 'r':
+            self._output.close()
+        if retcode:
+            raise Exception('pigz failed on {} with returncode {}'.format(
+                                                                          self.filename,
+                                                                          retcode))
+
+def open_gzip(filename, mode='r'):
+    '''Open gzipped file through pigz, or the gzip module if pigz is missing.
+
+    Args:
+        filename (str): Path of gzipped file.
+        mode (str): "r" to read or "w" to write.
+
+    Returns:
+        file: File-like object of uncompressed data.
+
+    '''
+
+    if find_executable('pigz'):
+        return PigzFile(filename, mode)
+    elif mode == 'r':
+        return gzip.open(filename, 'rb')
+    else:
+        return gzip.open(filename, 'wb', FASTQ_COMPRESSION_LEVEL)
+
+def get_quality_binning_table(scheme):
+    '''Get translation table that bins Phred+33 quality characters.
+
+    Args:
+        scheme (str): Name of scheme in QUALITY_BINNING_SCHEMES.
+
+    Returns:
+        str: Table for str.translate(); scores outside all bins are unchanged.
+
+    '''
+
+    table = [chr(index) for index in range(256)]
+    for low, high, binned in QUALITY_BINNING_SCHEMES[scheme]:
+        for score in range(low, high + 1):
+            table[score + 33] = chr(binned + 33)
+    return ''.join(table)
+
+def _iter_verified_fastq_data(fastq_path, verifier, chunk_size=UPLOAD_CHUNK_SIZE):
+    '''Stream uncompressed data of a gzipped fastq while checking it.
+
+    Args:
+        fastq_path (str): Local path of gzipped fastq file.
+        verifier (FastqStreamVerifier): Checks the compressed file.
+        chunk_size (int): Size of compressed chunks to read.
+
+    Yields:
+        str: Uncompressed fastq data.
+
+    Raises:
+        ValueError: If the gzip stream or fastq records are corrupt.
+
+    '''
+
+    with open(fastq_path, 'rb') as FASTQ:
+        for chunk in iter(lambda: FASTQ.read(chunk_size), ''):
+            yield verifier.update(chunk)
+
+def _bin_fastq_chunks(data_chunks, table):
+    '''Bin quality lines of a stream of uncompressed fastq data.
+
+    Args:
+        data_chunks (iterable): Uncompressed fastq data, split anywhere.
+        table (str): Quality binning translation table.
+
+    Yields:
+        str: Fastq data with binned quality lines.
+
+    '''
+
+    partial_line = ''
+    line_count = 0
+    for data in data_chunks:
+        lines = (partial_line + data).split('\n')
+        partial_line = lines.pop()
+        # Quality lines are every fourth line of the file
+        offset = (3 - line_count) % 4
+        lines[offset::4] = [line.translate(table) for line in lines[offset::4]]
+        line_count += len(lines)
+        if lines:
+            yield '\n'.join(lines) + '\n'
+    if partial_line:
+        if line_count % 4 == 3:
+            partial_line = partial_line.translate(table)
+        yield partial_line
+
+def _write_binned_fastq(binned_data, output, errors):
+    '''Write fastq data with binned quality scores to an open file.
+
+    Run in a separate thread; exceptions are appended to 'errors'.
+
+    Args:
+        binned_data (iterable): Uncompressed fastq data to write.
+        output (file): File to write uncompressed fastq to.
+        errors (list): Exceptions raised while writing.
+
+    '''
+
+    try:
+        for data in binned_data:
+            output.write(data)
+    except Exception as error:
+        errors.append(error)
+    finally:
+        try:
+            output.close()
+        except IOError as error:
+            # Reader was stopped before all data was written
+            errors.append(error)
+
+def iter_binned_fastq(fastq_path, scheme, verifier, chunk_size=UPLOAD_CHUNK_SIZE):
+    '''Stream gzipped fastq with quality scores binned.
+
+    The source fastq is checked by 'verifier' as it is decompressed. 
+    Quality lines are binned & the result is recompressed with all cores 
+    by pigz, or by zlib if pigz is missing. Closing the generator early 
+    stops pigz and the thread writing to it.
+
+    Args:
+        fastq_path (str): Local path of gzipped fastq file.
+        scheme (str): Name of scheme in QUALITY_BINNING_SCHEMES.
+        verifier (FastqStreamVerifier): Checks the source fastq; call its
+                                        finish() once all chunks are read.
+        chunk_size (int): Size of compressed chunks to yield.
+
+    Yields:
+        str: Chunks of gzipped fastq with binned quality scores.
+
+    Raises:
+        ValueError: If the source gzip stream or fastq records are corrupt.
+
+    '''
+
+    binned_data = _bin_fastq_chunks(
+                                    _iter_verified_fastq_data(fastq_path, verifier, chunk_size),
+                                    get_quality_binning_table(scheme))
+    if not find_executable('pigz'):
+        compressor = zlib.compressobj(FASTQ_COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for data in binned_data:
+            chunk = compressor.compress(data)
+            if chunk:
+                yield chunk
+        yield compressor.flush()
+        return
+
+    pigz = subprocess.Popen(
+                            ['pigz', '-c', '-{}'.format(FASTQ_COMPRESSION_LEVEL)],
+                            stdin = subprocess.PIPE,
+                            stdout = subprocess.PIPE,
+                            bufsize = -1)
+    errors = []
+    writer = threading.Thread(
+                              target = _write_binned_fastq,
+                              args = (binned_data, pigz.stdin, errors))
+    writer.daemon = True
+    writer.start()
+    try:
+        for chunk in iter(lambda: pigz.stdout.read(chunk_size), ''):
+            yield chunk
+    finally:
+        # Abandoned upload: stop pigz so the writer thread cannot block
+        if pigz.poll() is None and writer.is_alive():
+            pigz.kill()
+        writer.join()
+        pigz.stdout.close()
+        retcode = pigz.wait()
+
+    source_errors = [error for error in errors if isinstance(error, ValueError)]
+    if source_errors:
+        raise source_errors[0]
+    if errors:
+        raise errors[0]
+    if retcode:
+        raise Exception('pigz failed binning {} with returncode {}'.format(
+                                                                           fastq_path,
+                                                                           retcode))
+
+class Bcl2fastqProgress:
+    '''Parses bcl2fastq2 console output into progress events.
+
+    bcl2fastq2 reports its work per tile. A tile is counted as processed once
+    a later tile is first mentioned, since bcl2fastq2 moves on to a new tile
+    only after finishing the previous one; all tiles are counted when the
+    run ends. Events are logged by a background timer, so they continue while
+    bcl2fastq2 is silent, and throughput gauges are rates over the interval
+    since the previous event rather than averages since the start.
+
+    Args:
+        total_tiles (int): Number of tiles bcl2fastq2 will process.
+        output_dir (str): Directory bcl2fastq2 is writing fastqs to.
+        interval (int): Number of seconds between progress events.
+
+    Attributes:
+        total_tiles (int): Number of tiles bcl2fastq2 will process.
+        output_dir (str): Directory bcl2fastq2 is writing fastqs to.
+        interval (int): Number of seconds between progress events.
+        tiles (list): Names of tiles reported by bcl2fastq2 so far, in order.
+        line_count (int): Number of output lines read so far.
+        finished (bool): Whether bcl2fastq2 has exited.
+        events (list): Progress events, as dictionaries, in order of logging.
+
+    '''
+
+    TILE_PATTERN = re.compile(r'\btile\s+(\d+)', re.IGNORECASE)
+
+    def __init__(self, total_tiles, output_dir, interval=PROGRESS_INTERVAL):
+
+        self.total_tiles = total_tiles
+        self.output_dir = output_dir
+        self.interval = interval
+        self.tiles = []
+        self.line_count = 0
+        self.finished = False
+        self.events = []
+        self.start_time = time.time()
+        self._seen_tiles = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._timer = None
+        self._last_sample = (self.start_time, 0, 0, 0)
+
+    def __call__(self, line):
+        '''Record one line of bcl2fastq2 output.
+
+        Args:
+            line (str): Line of bcl2fastq2 output.
+
+        '''
+
+        match = self.TILE_PATTERN.search(line)
+        with self._lock:
+            self.line_count += 1
+            if match and not match.group(1) in self._seen_tiles:
+                self._seen_tiles.add(match.group(1))
+                self.tiles.append(match.group(1))
+
+    @property
+    def tiles_processed(self):
+        '''int: Number of tiles bcl2fastq2 has finished.'''
+
+        if self.finished:
+            return len(self.tiles)
+        # The most recently mentioned tile is still in progress
+        return max(len(self.tiles) - 1, 0)
+
+    def start(self):
+        '''Start logging progress events every 'interval' seconds.'''
+
+        self._timer = threading.Thread(target=self._log_periodically)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def stop(self, finished=True):
+        '''Stop the timer and log a final progress event.
+
+        Args:
+            finished (bool): Whether bcl2fastq2 completed all its tiles.
+
+        Returns:
+            dict: Final progress event.
+
+        '''
+
+        self._stopped.set()
+        if self._timer:
+            self._timer.join()
+        self.finished = finished
+        return self.log_event()
+
+    def _log_periodically(self):
+        '''Log progress events until stopped.'''
+
+        while not self._stopped.wait(self.interval):
+            try:
+                self.log_event()
+            except Exception as error:
+                # Progress reporting must never stop bcl2fastq2
+                logger.warning('Could not log bcl2fastq progress: {}'.format(error))
+
+    def log_event(self):
+        '''Log current progress & throughput of bcl2fastq2.
+
+        Rates are computed over the interval since the previous event.
+
+        Returns:
+            dict: Progress event with tiles processed, elapsed time, estimated
+                  finish and throughput gauges.
+
+        '''
+
+        output_bytes = self._get_output_size()
+        with self._lock:
+            now = time.time()
+            tiles_done = self.tiles_processed
+            line_count = self.line_count
+            last_time, last_tiles, last_bytes, last_lines = self._last_sample
+            self._last_sample = (now, tiles_done, output_bytes, line_count)
+
+        elapsed = now - self.start_time
+        interval = now - last_time
+        tile_rate = (tiles_done - last_tiles) / interval if interval > 0 else 0.0
+
+        event = {
+                 'tiles_processed': tiles_done,
+                 'total_tiles': self.total_tiles,
+                 'elapsed_seconds': int(elapsed),
+                 'interval_seconds': int(interval),
+                 'tiles_per_minute': round(60 * tile_rate, 2),
+                 'output_mb_per_second': round((output_bytes - last_bytes) / 1e6 / interval, 2) if interval > 0 else 0.0,
+                 'lines_per_second': round((line_count - last_lines) / interval, 2) if interval > 0 else 0.0,
+                 'estimated_finish': None
+                }
+        if self.total_tiles:
+            fraction = min(float(tiles_done) / self.total_tiles, 1.0)
+            event['percent_complete'] = round(100 * fraction, 1)
+            if tile_rate > 0:
+                remaining = max(self.total_tiles - tiles_done, 0) / tile_rate
+                event['estimated_finish'] = datetime.datetime.fromtimestamp(
+                                                            now + remaining).isoformat()
+
+        logger.info('bcl2fastq progress: {}'.format(json.dumps(event, sort_keys=True)))
+        self.events.append(event)
+        return event
+
+    def _get_output_size(self):
+        '''Get total size of files written to output directory, in bytes.'''
+
+        total_size = 0
+        for root, dirnames, filenames in os.walk(self.output_dir):
+            for filename in filenames:
+                try:
+                    total_size += os.path.getsize(os.path.join(root, filename))
+                except OSError:
+                    # File was moved or removed by bcl2fastq2
+                    pass
+        return total_size
+
 class Bcl2fastqJob:
     '''Converts Illumina intensity files to fastqs.
 
@@ -348,18 +1226,46 @@ class Bcl2fastqJob:
 
         return sample_sheet, barcode_sample_dict
 
-    def run(self, tools_used_dict, options_dict, flags_dict):
+    def _count_tiles(self, run_info_file, tiles_option=None):
+        '''Count tiles bcl2fastq2 will process for this lane.
+
+        Args:
+            run_info_file (str): Path to RunInfo file.
+            tiles_option (str): Comma-separated regular expressions passed
+                                to bcl2fastq2 --tiles.
+
+        Returns:
+            int: Number of tiles, or None if they could not be determined.
+
+        '''
+
+        if not os.path.exists(run_info_file):
+            return None
+        tiles = get_lane_tiles(run_info_file, self.lane_index)
+        if tiles_option:
+            patterns = [re.compile(pattern) for pattern in tiles_option.split(',')]
+            tiles = [
+                     tile for tile in tiles
+                     if any(pattern.search('s_{}_{}'.format(self.lane_index, tile))
+                            for pattern in patterns)
+                    ]
+        return len(tiles) or None
+
+    def run(self, tools_used_dict, options_dict, flags_dict, run_info_file='RunInfo.xml'):
         '''Run bcl2fastq2 program.
 
+        Output of bcl2fastq2 is streamed to the log as it runs and progress
+        events are logged periodically.
+
         Args:
-            use_bases_mask (str): Description of barcode masking pattern
-            tools_used_dict (dict): Descritpion of executables and 
+            tools_used_dict (dict): Descritpion of executables and
                                     configurations used by App
             options_dict (dict): Qualitative app configuration data
             flags_dict (dict): Boolean app configuration data
+            run_info_file (str): Path to RunInfo file.
 
         Returns:
-            tuple: stdout,stderr information from running bcl2fastq2 executable
+            list: Progress events logged while running bcl2fastq2 executable
 
         '''
         
@@ -376,7 +1282,19 @@ class Bcl2fastqJob:
         logger.info('Running bcl2fastq v2 with command: {}'.format(command))
 
         tools_used_dict['commands'].append(command)
-        stdout,stderr = create_subprocess(cmd=command, pipeStdout=True)
+        progress = Bcl2fastqProgress(
+                                     total_tiles = self._count_tiles(
+                                                                     run_info_file,
+                                                                     options_dict.get('tiles')),
+                                     output_dir = options_dict['output_dir'])
+        progress.start()
+        finished = False
+        try:
+            stream_subprocess(cmd=command, line_handler=progress)
+            finished = True
+        finally:
+            progress.stop(finished)
+        return progress.events
 
 class GetUseBasesMaskJob:
     '''Calculates use_bases_mask value from barcodes & RunInfo.xml.
@@ -482,6 +1400,123 @@ class GetUseBasesMaskJob:
         index_lengths.append((i7_length, i5_length))
         return self._count_index_lengths(barcodes, index_lengths)
 
+    def _parse_read_structure(self, read_structure, run_info_file):
+        '''Parse read structure into segments of each sequencing read.
+
+        A read structure has one comma-separated entry per read in
+        RunInfo.xml. Each entry is a series of <length><type> segments, where
+        type is T (template), B (sample barcode), M (molecular barcode/UMI)
+        or S (skip). The last segment of a read may use "+" as its length to
+        cover the remaining cycles; i.e. "8M143T,8B,8B,151T".
+
+        Args:
+            read_structure (str): Read structure description.
+            run_info_file (str): Filename of RunInfo.xml file ("RunInfo.xml")
+
+        Returns:
+            list: Lists of (type, length) segments, one list per read.
+
+        '''
+
+        tree = ElementTree.parse(run_info_file)
+        read_lengths = [
+                        int(read_element.get('NumCycles'))
+                        for read_element in sorted(
+                                                   tree.findall(".//Read"),
+                                                   key=lambda element: int(element.get('Number')))
+                       ]
+        read_entries = read_structure.replace(' ', '').upper().split(',')
+        if len(read_entries) != len(read_lengths):
+            logger.error('Read structure {} has {} reads; RunInfo has {}'.format(
+                                                                               read_structure,
+                                                                               len(read_entries),
+                                                                               len(read_lengths)))
+            sys.exit()
+
+        reads = []
+        for number, (entry, read_length) in enumerate(zip(read_entries, read_lengths), 1):
+            if not re.match(r'^((\d+|\+)[TBMS])+$', entry):
+                logger.error('Invalid read structure for read {}: {}'.format(number, entry))
+                sys.exit()
+            segments = []
+            remaining = read_length
+            matches = re.findall(r'(\d+|\+)([TBMS])', entry)
+            for index, (length, segment_type) in enumerate(matches):
+                if length == '+':
+                    if index != len(matches) - 1:
+                        logger.error('Only the last segment of read {} '.format(number) +
+                                     'can have length "+": {}'.format(entry))
+                        sys.exit()
+                    length = remaining
+                segments.append((segment_type, int(length)))
+                remaining -= int(length)
+            if remaining != 0:
+                logger.error(
+                             'Read structure does not match read length. ' +
+                             'Read {}: {} Cycles. '.format(number, read_length) +
+                             'Read structure: {}.'.format(entry))
+                sys.exit()
+            reads.append(segments)
+        return reads
+
+    def run_read_structure(self, read_structure, run_info_file, umi_in_mask=True):
+        '''Calculate use-bases-mask from read structure.
+
+        Template segments become "y", sample barcodes "I", UMIs "U" and 
+        skipped cycles "n"; i.e. "8M143T,8B9M,8B,151T" gives 
+        "U8y143,I8U9,I8,y151". bcl2fastq2 v2.20 and later write UMI cycles 
+        into the read names of the fastqs it creates.
+
+        Older versions do not support "U". With umi_in_mask False, reads 
+        with template or UMI segments are instead written out whole, and 
+        their segments are returned so UmiFastqRewriter can move the UMI 
+        bases into the read names.
+
+        Args:
+            read_structure (str): Read structure description.
+            run_info_file (str): Path to RunInfo file.
+            umi_in_mask (bool): bcl2fastq2 supports "U" in the bases mask.
+
+        Returns:
+            tuple: (str) --use-bases-mask argument passed to bcl2fastq2;
+                   (list) segments of each fastq read to be rewritten, empty
+                   if UMIs are in the bases mask.
+
+        '''
+
+        mask_types = {'T': 'y', 'B': 'I', 'M': 'U', 'S': 'n'}
+        mask_elements = []
+        output_reads = []
+        for segments in self._parse_read_structure(read_structure, run_info_file):
+            segment_types = {segment_type for segment_type, length in segments}
+            read_length = sum(length for segment_type, length in segments)
+            if 'B' in segment_types and 'T' in segment_types:
+                logger.error('Sample barcode & template segments ' +
+                             'cannot share a read: {}'.format(segments))
+                sys.exit()
+            elif umi_in_mask:
+                mask_elements.append(''.join(
+                                             '{}{}'.format(mask_types[segment_type], length)
+                                             for segment_type, length in segments))
+            elif 'B' in segment_types:
+                if 'M' in segment_types:
+                    logger.error('bcl2fastq2 older than v{} cannot '.format(
+                                            '.'.join(str(number) for number in BCL2FASTQ_UMI_VERSION)) +
+                                 'read UMIs from an index read: {}'.format(segments))
+                    sys.exit()
+                mask_elements.append(''.join(
+                                             '{}{}'.format(mask_types[segment_type], length)
+                                             for segment_type, length in segments))
+            elif segment_types & {'T', 'M'}:
+                mask_elements.append('y{}'.format(read_length))
+                output_reads.append(segments)
+            else:
+                mask_elements.append('n{}'.format(read_length))
+
+        use_bases_mask = ','.join(mask_elements)
+        logger.info('--use-bases-mask {}'.format(use_bases_mask))
+        return use_bases_mask, output_reads
+
     def run(self, barcodes_list, run_info_file):
         '''Calculate use-bases-mask from read & index lengths.
 
@@ -497,89 +1532,1406 @@ class GetUseBasesMaskJob:
         if len(barcodes_list) == 0:
             index_lengths = (0,0)
         else:
-            index_lengths = self._count_index_lengths(barcodes_list)
+            index_lengths = self._count_index_lengths(barcodes_list, [])
         logger.info('Index lengths: {}'.format(index_lengths))
 
         use_bases_mask = self._get_use_bases_mask(run_info_file, index_lengths)
         logger.info('--use-bases-mask {}'.format(use_bases_mask))
         return use_bases_mask
 
-class Bcl2fastqFileUploader:
-    '''Upload bcl2fastq2 output files.
+class Bcl2fastqSmokeTestJob:
+    '''Checks demultiplexing settings on a small sample of tiles.
 
-    Upload resulting fastq files as well as intermediate and accessory files.
+    Runs bcl2fastq2 on a spatially spread subset of the lane's tiles and 
+    extrapolates per-sample yield & undetermined fraction to the whole lane.
+    A wrong barcodes file or bases mask shows up as a high undetermined 
+    fraction or samples without reads, and the job is stopped before the 
+    full conversion is run. The most common unknown barcodes are compared 
+    with the barcodes file to diagnose reverse complemented or swapped 
+    indexes, and index cycles that carry no sample information are used to
+    suggest a bases mask.
 
     Args:
-        project_dxid (str): ID of project where files will be uploaded.
-        project_path (str): Folder path where files will be uploaded. 
+        tile_count (int): Number of tiles to sample.
+        max_undetermined (float): Largest acceptable fraction of 
+                                  undetermined reads.
 
     Attributes:
-        project_dxid (str): ID of project where files will be uploaded.
-        project_path (str): Folder path where files will be uploaded.
+        tile_count (int): Number of tiles to sample.
+        max_undetermined (float): Largest acceptable fraction of 
+                                  undetermined reads.
 
     '''
 
-    def __init__(self, project_dxid, project_path):
+    def __init__(self, tile_count, max_undetermined):
 
-        self.project_dxid = project_dxid
-        self.project_path = project_path
+        self.tile_count = tile_count
+        self.max_undetermined = max_undetermined
 
-    def upload_fastq_files(self, raw_properties, tags):
-        '''Recursively find and upload all fastqs to DNAnexus object store.
+    def _select_tiles(self, tiles):
+        '''Select evenly spaced tiles across surfaces & swaths.
 
         Args:
-            raw_properties (dict): Properties with values of different types.
-            tags (list): List of descriptive tags.
+            tiles (list): All tile names, ordered by surface, swath and tile.
 
         Returns:
-            list: DXLinks to all uploaded fastq files.
-        
-        '''
+            list: Names of selected tiles.
 
-        fastq_dxlinks = []
-        for fastq in self._find_fastqs():
-            fastq_metadata = self._get_scgpm_fastq_name(
-                                                        fastq, 
-                                                        raw_properties['flowcell_id'], 
-                                                        raw_properties['library_name'], 
-                                                        raw_properties['lane_index'])
-            scgpm_name = fastq_metadata[0] 
-            barcode = fastq_metadata[1]
-            read_index = fastq_metadata[2]
-            
-            # Convert all property values to strings
-            properties = {key : str(value) for key, value in raw_properties.items()}
-            properties['barcode'] = barcode
-            properties['read_index'] = read_index
+        '''
 
-            project_folder = '{}/fastqs'.format(self.project_path)
-            fastq_dxid = dxpy.upload_local_file(
-                                                filename = fastq, 
-                                                name = scgpm_name, 
-                                                properties = properties, 
-                                                tags = tags,
-                                                project = self.project_dxid, 
-                                                folder = project_folder,
-                                                parents = True)
-            fastq_dxlink = dxpy.dxlink(fastq_dxid)
-            fastq_dxlinks.append(fastq_dxlink)
-        return fastq_dxlinks
+        if len(tiles) <= self.tile_count:
+            return list(tiles)
+        step = float(len(tiles)) / self.tile_count
+        return [tiles[int(step * (index + 0.5))] for index in range(self.tile_count)]
 
-    def upload_sample_sheet(self, local_file_path, raw_properties):
-        '''Upload sample sheet to DNAnexus project.
+    def _parse_demultiplexing_stats(self, stats_file):
+        '''Get read counts per sample from bcl2fastq2 DemultiplexingStats.xml.
 
         Args:
-            local_file_path (str): Local path of sample sheet.
-            raw_properties (dict): Properties with values of different types.
+            stats_file (str): Path to DemultiplexingStats.xml file.
 
         Returns:
-            str: DXLink to sample sheet on DNAnexus object store.
+            dict: Sample name:read count, including "Undetermined".
 
         '''
 
-        # Convert all property values to strings
-        properties = {key : str(value) for key, value in raw_properties.items()}
-        properties['file_type'] = 'sample_sheet'
+        read_counts = {}
+        tree = ElementTree.parse(stats_file)
+        for project in tree.findall('.//Project'):
+            if project.get('name') == 'all':
+                continue
+            for sample in project.findall('Sample'):
+                for barcode in sample.findall('Barcode'):
+                    if barcode.get('name') == 'all':
+                        continue
+                    for lane in barcode.findall('Lane'):
+                        sample_name = sample.get('name')
+                        read_counts[sample_name] = (
+                                                    read_counts.get(sample_name, 0) + 
+                                                    int(lane.findtext('BarcodeCount')))
+        return read_counts
+
+    def _parse_unknown_barcodes(self, stats_file, lane_index):
+        '''Get unknown barcode read counts from bcl2fastq2 Stats.json.
+
+        Args:
+            stats_file (str): Path to Stats.json file.
+            lane_index (int): Flowcell lane.
+
+        Returns:
+            dict: Barcode:read count, with indexes joined by "-" as in the
+                  barcodes file. Empty if Stats.json was not written.
+
+        '''
+
+        unknown_barcodes = {}
+        if not os.path.exists(stats_file):
+            logger.warning('No {}; cannot check unknown barcodes'.format(stats_file))
+            return unknown_barcodes
+        with open(stats_file, 'r') as STATS:
+            stats = json.load(STATS)
+        for lane in stats.get('UnknownBarcodes', []):
+            if int(lane.get('Lane', 0)) != int(lane_index):
+                continue
+            for barcode, count in lane.get('Barcodes', {}).items():
+                barcode = str(barcode).replace('+', '-')
+                unknown_barcodes[barcode] = unknown_barcodes.get(barcode, 0) + int(count)
+        return unknown_barcodes
+
+    def _diagnose_barcodes(self, unknown_barcodes, barcodes):
+        '''Find a barcodes file error that explains the unknown barcodes.
+
+        Expected barcodes are checked against the unknown barcodes after 
+        reverse complementing i7 and/or i5 or swapping them, and for an i5 
+        read of one repeated base, as read from libraries without an i5 index.
+
+        Args:
+            unknown_barcodes (dict): Barcode:read count of unknown barcodes.
+            barcodes (list): Barcodes from the barcodes file.
+
+        Returns:
+            dict: Diagnosis & fraction of unknown barcode reads it explains;
+                  None if no diagnosis explains enough of them.
+
+        '''
+
+        unknown_reads = sum(unknown_barcodes.values())
+        if not unknown_reads or not barcodes:
+            return None
+
+        indexes_list = [barcode.split('-') for barcode in barcodes]
+        transforms = [
+                      ('i7 reverse complemented', 
+                       lambda indexes: [_reverse_complement(indexes[0])] + indexes[1:]),
+                      ('i5 reverse complemented',
+                       lambda indexes: indexes[:1] + [_reverse_complement(index) for index in indexes[1:]]),
+                      ('i7 & i5 reverse complemented',
+                       lambda indexes: [_reverse_complement(index) for index in indexes]),
+                      ('i7 & i5 swapped',
+                       lambda indexes: indexes[::-1])
+                     ]
+        candidates = []
+        for diagnosis, transform in transforms:
+            # Palindromes & single indexes are unchanged; they are not evidence
+            expected = {'-'.join(transform(indexes)) for indexes in indexes_list}
+            expected.difference_update(barcodes)
+            reads = sum(
+                        count for barcode, count in unknown_barcodes.items() 
+                        if barcode in expected)
+            candidates.append((reads, diagnosis))
+
+        i7_indexes = {indexes[0] for indexes in indexes_list}
+        reads = 0
+        for barcode, count in unknown_barcodes.items():
+            indexes = barcode.split('-')
+            if len(indexes) == 2 and indexes[0] in i7_indexes and len(set(indexes[1])) == 1:
+                reads += count
+        candidates.append((reads, 'no i5 index in library'))
+
+        reads, diagnosis = max(candidates)
+        fraction = float(reads) / unknown_reads
+        if fraction < SMOKE_DIAGNOSIS_FRACTION:
+            return None
+        return {'diagnosis': diagnosis, 'unknown_fraction': round(fraction, 4)}
+
+    def _get_observed_index_lengths(self, unknown_barcodes, diagnosis):
+        '''Get the number of informative cycles seen in each index read.
+
+        The most common unknown barcodes, covering SMOKE_COMMON_FRACTION 
+        of unknown reads, are compared. Trailing cycles that are identical 
+        in all of them (i.e. adapter read after a short index) carry no 
+        sample information. Needs SMOKE_MIN_DISTINCT_BARCODES barcodes, 
+        except for an i5 of one repeated base which is dropped entirely.
+
+        Args:
+            unknown_barcodes (dict): Barcode:read count of unknown barcodes.
+            diagnosis (dict): Result of _diagnose_barcodes(), or None.
+
+        Returns:
+            list: Informative cycles of each index read; None if the 
+                  unknown barcodes do not show any.
+
+        '''
+
+        if not unknown_barcodes:
+            return None
+        unknown_reads = sum(unknown_barcodes.values())
+        common_barcodes = []
+        covered_reads = 0
+        for barcode, count in sorted(unknown_barcodes.items(), key=lambda item: -item[1]):
+            common_barcodes.append(barcode.split('-'))
+            covered_reads += count
+            if covered_reads >= unknown_reads * SMOKE_COMMON_FRACTION:
+                break
+        if len({len(indexes) for indexes in common_barcodes}) != 1:
+            return None
+
+        index_lengths = [len(index) for index in common_barcodes[0]]
+        if len(common_barcodes) >= SMOKE_MIN_DISTINCT_BARCODES:
+            for number, index_length in enumerate(index_lengths):
+                while (index_length > 0 and 
+                       len({indexes[number][index_length - 1] for indexes in common_barcodes}) == 1):
+                    index_length -= 1
+                index_lengths[number] = index_length
+        if diagnosis and diagnosis['diagnosis'] == 'no i5 index in library':
+            index_lengths[1] = 0
+        return index_lengths
+
+    def _suggest_use_bases_mask(self, use_bases_mask, index_lengths):
+        '''Shorten the index cycles of a bases mask to the observed lengths.
+
+        Args:
+            use_bases_mask (str): Bases mask used for the smoke test.
+            index_lengths (list): Informative cycles of each index read.
+
+        Returns:
+            str: Suggested bases mask; None if it is unchanged or the mask
+                 cannot be adjusted.
+
+        '''
+
+        if not use_bases_mask or not index_lengths:
+            return None
+        mask_elements = use_bases_mask.split(',')
+        index_number = 0
+        for position, element in enumerate(mask_elements):
+            match = re.match(r'^I(\d+)(?:n(\d+))?$', element, re.IGNORECASE)
+            if not match:
+                if 'I' in element.upper():
+                    # Index cycles after skipped cycles; leave to the user
+                    return None
+                continue
+            if index_number >= len(index_lengths):
+                return None
+            read_length = int(match.group(1)) + int(match.group(2) or 0)
+            index_length = min(index_lengths[index_number], read_length)
+            index_mask = 'I{}'.format(index_length) if index_length else ''
+            n_mask = 'n{}'.format(read_length - index_length) if read_length > index_length else ''
+            mask_elements[position] = index_mask + n_mask
+            index_number += 1
+        suggested_mask = ','.join(mask_elements)
+        if suggested_mask == use_bases_mask:
+            return None
+        return suggested_mask
+
+    def run(self, bcl_job, tools_used_dict, options_dict, flags_dict, 
+            barcode_sample_dict, read_structure=None, run_info_file='RunInfo.xml'):
+        '''Run bcl2fastq2 on sampled tiles & check the results.
+
+        Args:
+            bcl_job (Bcl2fastqJob): Job used for the full conversion.
+            tools_used_dict (dict): Description of executables and 
+                                    configurations used by App
+            options_dict (dict): Qualitative app configuration data
+            flags_dict (dict): Boolean app configuration data
+            barcode_sample_dict (dict): Barcode:sample_id, None if no barcodes.
+            read_structure (str): Read structure the bases mask was built 
+                                  from; the mask is then not questioned.
+            run_info_file (str): Path to RunInfo file.
+
+        Returns:
+            dict: Smoke test report with sampled tiles, extrapolated yield per
+                  sample, undetermined fraction and suggested bases mask.
+
+        '''
+
+        all_tiles = get_lane_tiles(run_info_file, bcl_job.lane_index)
+        tiles = self._select_tiles(all_tiles)
+        if not tiles:
+            logger.warning('Could not determine tiles; skipping smoke test')
+            return None
+        logger.info('Running smoke test on tiles: {}'.format(tiles))
+
+        smoke_options = dict(options_dict)
+        smoke_options['output_dir'] = SMOKE_OUTPUT
+        smoke_options['tiles'] = ','.join(
+                                          's_{}_{}'.format(bcl_job.lane_index, tile)
+                                          for tile in tiles)
+        events = bcl_job.run(
+                             tools_used_dict = tools_used_dict,
+                             options_dict = smoke_options,
+                             flags_dict = flags_dict,
+                             run_info_file = run_info_file)
+
+        stats_file = '{}/Stats/DemultiplexingStats.xml'.format(SMOKE_OUTPUT)
+        read_counts = self._parse_demultiplexing_stats(stats_file)
+        scale = float(len(all_tiles)) / len(tiles)
+        total_reads = sum(read_counts.values())
+        undetermined_reads = read_counts.pop('Undetermined', 0)
+
+        report = {
+                  'tiles': tiles,
+                  'total_tiles': len(all_tiles),
+                  'estimated_reads': int(total_reads * scale),
+                  'estimated_undetermined_reads': int(undetermined_reads * scale),
+                  'undetermined_fraction': (
+                                            round(float(undetermined_reads) / total_reads, 4)
+                                            if total_reads else None),
+                  'use_bases_mask': options_dict.get('use_bases_mask'),
+                  'suggested_use_bases_mask': None
+                 }
+        if events:
+            report['estimated_run_seconds'] = int(events[-1]['elapsed_seconds'] * scale)
+
+        problems = []
+        if total_reads == 0:
+            problems.append('no reads were converted')
+        if barcode_sample_dict:
+            sample_ids = [
+                          sample_id or barcode 
+                          for barcode, sample_id in barcode_sample_dict.items()
+                         ]
+            report['estimated_sample_reads'] = {
+                                                sample_id : int(read_counts.get(sample_id, 0) * scale)
+                                                for sample_id in sample_ids
+                                               }
+            empty_samples = [
+                             sample_id for sample_id in sample_ids 
+                             if not read_counts.get(sample_id)
+                            ]
+            if empty_samples:
+                problems.append('samples without reads: {}'.format(empty_samples))
+            if (report['undetermined_fraction'] is not None and
+                report['undetermined_fraction'] > self.max_undetermined):
+                problems.append('undetermined fraction {} exceeds {}'.format(
+                                                                            report['undetermined_fraction'],
+                                                                            self.max_undetermined))
+
+            # Compare what was actually sequenced with the barcodes file
+            unknown_barcodes = self._parse_unknown_barcodes(
+                                            stats_file = '{}/Stats/Stats.json'.format(SMOKE_OUTPUT),
+                                            lane_index = bcl_job.lane_index)
+            diagnosis = self._diagnose_barcodes(
+                                                unknown_barcodes = unknown_barcodes,
+                                                barcodes = list(barcode_sample_dict.keys()))
+            report['barcode_diagnosis'] = diagnosis
+            if diagnosis:
+                logger.warning('Unknown barcodes suggest {} '.format(diagnosis['diagnosis']) +
+                               '({} of unknown barcode reads)'.format(diagnosis['unknown_fraction']))
+
+            index_lengths = self._get_observed_index_lengths(unknown_barcodes, diagnosis)
+            report['observed_index_lengths'] = index_lengths
+            report['suggested_use_bases_mask'] = self._suggest_use_bases_mask(
+                                                                use_bases_mask = report['use_bases_mask'],
+                                                                index_lengths = index_lengths)
+            if report['suggested_use_bases_mask'] and read_structure:
+                logger.info('Bases mask set by read structure {}; '.format(read_structure) +
+                            'not suggesting {}'.format(report['suggested_use_bases_mask']))
+                report['suggested_use_bases_mask'] = None
+            elif report['suggested_use_bases_mask']:
+                logger.warning('Unknown barcodes suggest --use-bases-mask {} instead of {}'.format(
+                                                                    report['suggested_use_bases_mask'],
+                                                                    report['use_bases_mask']))
+
+        logger.info('Smoke test report: {}'.format(json.dumps(report, sort_keys=True)))
+        shutil.rmtree(SMOKE_OUTPUT)
+        if problems:
+            raise Exception('Smoke test failed; stopping before full conversion: ' +
+                            '{}. Report: {}'.format('; '.join(problems), 
+                                                   json.dumps(report, sort_keys=True)))
+        return report
+
+def _reverse_complement(sequence):
+    '''Get the reverse complement of a DNA sequence.'''
+
+    return sequence.upper().translate(COMPLEMENT_TABLE)[::-1]
+
+def _get_segment_slices(segments, segment_type):
+    '''Get (start, end) positions of segments of one type within a read.'''
+
+    slices = []
+    start = 0
+    for current_type, length in segments:
+        if current_type == segment_type:
+            slices.append((start, start + length))
+        start += length
+    return slices
+
+class FollowedGzipFile:
+    '''Reads a gzipped file while another process is still writing it.
+
+    Compressed bytes are decompressed as they are written. At the end of 
+    the written data, more is waited for until "done_file" exists, which 
+    signals that the writer has closed the file. Only complete lines are 
+    returned before then.
+
+    Args:
+        filename (str): Path of gzipped file.
+        done_file (str): Path created once the writer is finished.
+
+    Attributes:
+        filename (str): Path of gzipped file.
+        done_file (str): Path created once the writer is finished.
+
+    '''
+
+    def __init__(self, filename, done_file):
+
+        self.filename = filename
+        self.done_file = done_file
+        self._file = None
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._lines = collections.deque()
+        self._partial_line = ''
+        self._finished = False
+
+    def _read_chunk(self):
+        '''Decompress the next written bytes into the queue of lines.
+
+        Returns:
+            bool: False once the writer is finished & all data is read.
+
+        '''
+
+        while True:
+            if self._file is None:
+                if os.path.exists(self.filename):
+                    self._file = open(self.filename, 'rb')
+                elif os.path.exists(self.done_file):
+                    raise Exception('bcl2fastq2 did not write {}'.format(self.filename))
+                else:
+                    time.sleep(FOLLOW_POLL_INTERVAL)
+                continue
+
+            data = self._file.read(FOLLOW_CHUNK_SIZE)
+            if data:
+                self._add_lines(self._decompressor.decompress(data))
+                # bcl2fastq2 fastqs are made of multiple gzip members
+                while self._decompressor.unused_data:
+                    data = self._decompressor.unused_data
+                    self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    self._add_lines(self._decompressor.decompress(data))
+                return True
+            elif self._finished:
+                return False
+            elif os.path.exists(self.done_file):
+                # Read once more; the writer may have written before finishing
+                self._finished = True
+            else:
+                time.sleep(FOLLOW_POLL_INTERVAL)
+
+    def _add_lines(self, data):
+        '''Split decompressed data into lines, keeping any partial last line.
+
+        Args:
+            data (str): Decompressed data following the partial line.
+
+        '''
+
+        if not data:
+            return
+        lines = (self._partial_line + data).split('\n')
+        self._partial_line = lines.pop()
+        self._lines.extend(line + '\n' for line in lines)
+
+    def readline(self):
+        '''Read the next complete line; empty string at the end of the file.'''
+
+        while not self._lines:
+            if not self._read_chunk():
+                line = self._partial_line
+                self._partial_line = ''
+                return line
+        return self._lines.popleft()
+
+    def close(self):
+
+        if self._file:
+            self._file.close()
+
+def _rewrite_umi_fastq_set(fastq_set):
+    '''Rewrite the fastqs of one sample with UMIs in the read headers.
+
+    Defined at module level so it can be run by a multiprocessing pool.
+
+    Args:
+        fastq_set (tuple): (list) paths of bcl2fastq2 fastqs in read order;
+                           (list) paths of rewritten fastqs;
+                           (list) segments of each bcl2fastq2 read;
+                           (str) path created once bcl2fastq2 is finished.
+
+    Returns:
+        int: Number of reads rewritten.
+
+    '''
+
+    input_paths, output_paths, output_reads, done_file = fastq_set
+    template_reads = [
+                      index for index, segments in enumerate(output_reads)
+                      if _get_segment_slices(segments, 'T')
+                     ]
+    template_slices = {
+                       index : _get_segment_slices(output_reads[index], 'T')
+                       for index in template_reads
+                      }
+    umi_slices = [
+                  (index, start, end)
+                  for index, segments in enumerate(output_reads)
+                  for start, end in _get_segment_slices(segments, 'M')
+                 ]
+
+    readers = [FollowedGzipFile(path, done_file) for path in input_paths]
+    writers = [open_gzip('{}.tmp'.format(path), 'w') for path in output_paths]
+    read_count = 0
+    while True:
+        records = [
+                   [reader.readline().rstrip('\n') for line in range(4)]
+                   for reader in readers
+                  ]
+        if not records[0][0]:
+            if any(record[0] for record in records):
+                raise Exception('Fastqs have different numbers of reads: {}'.format(
+                                                                                  input_paths))
+            break
+
+        umi = '+'.join(records[index][1][start:end] for index, start, end in umi_slices)
+        for read_number, (index, writer) in enumerate(zip(template_reads, writers), 1):
+            header, sequence, separator, qualities = records[index]
+            name, space, comment = header.partition(' ')
+            if umi:
+                name = '{}:{}'.format(name, umi)
+            # Comment starts with the read number: "3:N:0:ATCACG"
+            original_number, colon, comment_tail = comment.partition(':')
+            if colon:
+                comment = '{}:{}'.format(read_number, comment_tail)
+            writer.write('{}{}{}\n{}\n+\n{}\n'.format(
+                          name,
+                          space,
+                          comment,
+                          ''.join(sequence[start:end] for start, end in template_slices[index]),
+                          ''.join(qualities[start:end] for start, end in template_slices[index])))
+        read_count += 1
+
+    for reader in readers:
+        reader.close()
+    for writer in writers:
+        writer.close()
+    for path in input_paths:
+        os.remove(path)
+    for path in output_paths:
+        os.rename('{}.tmp'.format(path), path)
+    return read_count
+
+class UmiFastqRewriter:
+    '''Moves UMI bases into fastq read headers for bcl2fastq2 before v2.20.
+
+    Fallback for bcl2fastq2 versions without "U" in the bases mask; newer 
+    versions write UMIs themselves (see GetUseBasesMaskJob.run_read_structure).
+    Reads with UMI or skipped segments are then written whole by bcl2fastq2.
+    Worker processes follow the fastqs of one sample at a time while 
+    bcl2fastq2 is writing them and rewrite them in a single streaming pass.
+    Samples beyond the number of workers are rewritten once a worker is free,
+    so with many samples part of the work is left for after the conversion.
+    UMI bases are appended to the read 
+    name ("@<name>:<UMI>"), with multiple UMIs joined by "+", as bcl2fastq2
+    v2.20 does. Only template bases are kept in the reads. Reads with only 
+    UMI bases are dropped, and the remaining reads are renumbered R1, R2, 
+    and so on.
+
+    Args:
+        output_reads (list): Segments of each fastq read written by bcl2fastq2.
+        processes (int): Most samples to rewrite in parallel; defaults to
+                         half the CPUs, leaving the rest to bcl2fastq2.
+
+    Attributes:
+        output_reads (list): Segments of each fastq read written by bcl2fastq2.
+        processes (int): Most samples to rewrite in parallel.
+
+    '''
+
+    def __init__(self, output_reads, processes=None):
+
+        self.output_reads = output_reads
+        self.processes = processes or max(multiprocessing.cpu_count() // 2, 1)
+        self._pool = None
+        self._result = None
+        self._done_file = None
+
+    def needs_rewrite(self):
+        '''Check whether any read has UMI or skipped segments.
+
+        Returns:
+            bool: True if bcl2fastq2 fastqs have to be rewritten.
+
+        '''
+
+        return any(
+                   segment_type in ('M', 'S')
+                   for segments in self.output_reads
+                   for segment_type, length in segments)
+
+    def _find_fastq_sets(self, output_dir, sample_ids, lane_index):
+        '''Get the fastqs bcl2fastq2 will write for each sample.
+
+        Args:
+            output_dir (str): bcl2fastq2 output directory.
+            sample_ids (list): Sample IDs in sample sheet order.
+            lane_index (int): Index of Illumina flowcell lane (1-8).
+
+        Returns:
+            list: (input paths, output paths, read segments, done file) of
+                  each sample, including Undetermined.
+
+        '''
+
+        template_count = len([
+                              segments for segments in self.output_reads
+                              if _get_segment_slices(segments, 'T')
+                             ])
+        fastq_sets = []
+        samples = [('Undetermined', 0)] + [
+                                           (sample_id, number) 
+                                           for number, sample_id in enumerate(sample_ids, 1)
+                                          ]
+        for sample_id, number in samples:
+            prefix = get_fastq_prefix(output_dir, sample_id, number, lane_index)
+            input_paths = [
+                           '{}_R{}_001.fastq.gz'.format(prefix, read_number)
+                           for read_number in range(1, len(self.output_reads) + 1)
+                          ]
+            output_paths = [
+                            '{}_R{}_001.fastq.gz'.format(prefix, read_number)
+                            for read_number in range(1, template_count + 1)
+                           ]
+            fastq_sets.append((input_paths, output_paths, self.output_reads, self._done_file))
+        return fastq_sets
+
+    def start(self, output_dir, sample_ids, lane_index):
+        '''Start following the fastqs bcl2fastq2 writes into output directory.
+
+        Call before bcl2fastq2 is started & call join() once it has finished.
+
+        Args:
+            output_dir (str): bcl2fastq2 output directory.
+            sample_ids (list): Sample IDs in sample sheet order.
+            lane_index (int): Index of Illumina flowcell lane (1-8).
+
+        '''
+
+        self._done_file = '{}.bcl2fastq_done'.format(output_dir.rstrip('/'))
+        if os.path.exists(self._done_file):
+            os.remove(self._done_file)
+        fastq_sets = self._find_fastq_sets(output_dir, sample_ids, lane_index)
+        processes = min(self.processes, len(fastq_sets))
+        logger.info('Moving UMIs into read headers of {} samples with {} processes'.format(
+                                                                                         len(fastq_sets),
+                                                                                         processes))
+        self._pool = multiprocessing.Pool(processes)
+        # One sample per task, so free workers pick up the next sample
+        self._result = self._pool.map_async(_rewrite_umi_fastq_set, fastq_sets, chunksize=1)
+
+    def join(self):
+        '''Signal that bcl2fastq2 has finished & wait for the rewrites.
+
+        Returns:
+            dict: Read structure segments & number of reads rewritten.
+
+        '''
+
+        open(self._done_file, 'w').close()
+        try:
+            read_counts = self._result.get()
+        finally:
+            self._pool.close()
+            self._pool.join()
+            os.remove(self._done_file)
+        return {
+                'read_segments': self.output_reads,
+                'reads_rewritten': sum(read_counts)
+               }
+
+    def terminate(self):
+        '''Stop rewriting, i.e. after bcl2fastq2 failed.'''
+
+        self._pool.terminate()
+        self._pool.join()
+
+class UndemultiplexedCache:
+    '''Compact intermediate of all PF reads of a lane with their index reads.
+
+    Built once from the bcl2fastq2 output of all samples, including
+    Undetermined, so reads can later be reassigned to a corrected sample
+    sheet without decoding BCL files again. The file is gzipped text with
+    one cluster per line, including the sample bcl2fastq2 assigned it to and
+    the comment of its first read header without the read number, which 
+    keeps the filter & control bits:
+
+        <index1>[+<index2>] <tab> <sample ID> <tab> <read name> <tab> <comment> <tab> <seq 1> <tab> <qual 1> ...
+
+    Args:
+        filename (str): Path of intermediate file.
+
+    Attributes:
+        filename (str): Path of intermediate file.
+
+    '''
+
+    FASTQ_PATTERN = re.compile(r'^(.+)_([RI])(\d)_001\.fastq\.gz$')
+    SAMPLE_NUMBER_PATTERN = re.compile(r'_S(\d+)_L\d{3}$')
+
+    def __init__(self, filename):
+
+        self.filename = filename
+
+    def _find_fastq_sets(self, output_dir):
+        '''Group bcl2fastq2 read & index fastqs of each sample.
+
+        Args:
+            output_dir (str): bcl2fastq2 output directory.
+
+        Returns:
+            list: (fastq path prefix, read fastq paths, index fastq paths) of
+                  each sample, each in read order.
+
+        '''
+
+        fastq_sets = {}
+        for root, dirnames, filenames in os.walk(output_dir):
+            for filename in filenames:
+                match = self.FASTQ_PATTERN.match(filename)
+                if not match:
+                    continue
+                prefix, read_type, number = match.groups()
+                fastq_set = fastq_sets.setdefault(os.path.join(root, prefix), {'R': {}, 'I': {}})
+                fastq_set[read_type][int(number)] = os.path.join(root, filename)
+        return [
+                (
+                 prefix,
+                 [paths for number, paths in sorted(fastq_set['R'].items())],
+                 [paths for number, paths in sorted(fastq_set['I'].items())])
+                for prefix, fastq_set in sorted(fastq_sets.items())
+               ]
+
+    def _get_sample_id(self, prefix, sample_ids):
+        '''Get sample ID of a bcl2fastq2 fastq from its sample number.
+
+        Args:
+            prefix (str): Fastq path prefix; i.e. "output/SampleA_S1_L001".
+            sample_ids (list): Sample IDs in sample sheet order.
+
+        Returns:
+            str: Sample ID; "Undetermined" for sample number 0.
+
+        '''
+
+        match = self.SAMPLE_NUMBER_PATTERN.search(prefix)
+        if not match:
+            raise Exception('No sample number in fastq name {}'.format(prefix))
+        number = int(match.group(1))
+        if number == 0:
+            return RedemultiplexJob.UNDETERMINED
+        elif number > len(sample_ids):
+            raise Exception('Sample number of {} is not in the sample sheet: {}'.format(
+                                                                                      prefix,
+                                                                                      sample_ids))
+        return sample_ids[number - 1]
+
+    def build(self, output_dir, manifest, sample_ids):
+        '''Write all reads of bcl2fastq2 output into the intermediate.
+
+        Args:
+            output_dir (str): bcl2fastq2 output directory; fastqs must have
+                              been created with --create-fastq-for-index-reads.
+            manifest (dict): Demultiplexing settings of the run.
+            sample_ids (list): Sample IDs in sample sheet order.
+
+        Returns:
+            dict: Manifest updated with read & index read counts.
+
+        '''
+
+        fastq_sets = self._find_fastq_sets(output_dir)
+        read_count = 0
+        with open_gzip(self.filename, 'w') as CACHE:
+            for prefix, read_paths, index_paths in fastq_sets:
+                sample_id = self._get_sample_id(prefix, sample_ids)
+                if not index_paths and manifest['barcode_sample_dict']:
+                    raise Exception('No index read fastqs for {}'.format(read_paths))
+                readers = [open_gzip(path, 'r') for path in read_paths + index_paths]
+                while True:
+                    records = [
+                               [reader.readline().rstrip('\n') for line in range(4)]
+                               for reader in readers
+                              ]
+                    if not records[0][0]:
+                        break
+                    read_records = records[:len(read_paths)]
+                    index_records = records[len(read_paths):]
+                    name, space, comment = read_records[0][0][1:].partition(' ')
+                    fields = [
+                              '+'.join(record[1] for record in index_records),
+                              sample_id,
+                              name,
+                              # Comment starts with the read number: "1:Y:0:ATCACG"
+                              comment.partition(':')[2]]
+                    for record in read_records:
+                        fields.extend([record[1], record[3]])
+                    CACHE.write('\t'.join(fields) + '\n')
+                    read_count += 1
+                for reader in readers:
+                    reader.close()
+
+        manifest = dict(manifest)
+        manifest['read_count'] = read_count
+        manifest['output_read_count'] = len(fastq_sets[0][1]) if fastq_sets else 0
+        manifest['index_read_count'] = len(fastq_sets[0][2]) if fastq_sets else 0
+        logger.info('Cached {} undemultiplexed reads in {}'.format(read_count, self.filename))
+        return manifest
+
+    def remove_index_fastqs(self, output_dir):
+        '''Remove index read fastqs once they are cached.
+
+        Args:
+            output_dir (str): bcl2fastq2 output directory.
+
+        '''
+
+        for prefix, read_paths, index_paths in self._find_fastq_sets(output_dir):
+            for path in index_paths:
+                os.remove(path)
+
+    def iter_records(self):
+        '''Stream clusters from the intermediate.
+
+        Yields:
+            tuple: (str) index reads; (str) sample ID assigned by bcl2fastq2;
+                   (str) read name; (str) header comment after the read 
+                   number, i.e. "N:0:ATCACG"; (list) fields of sequences & 
+                   qualities of each read.
+
+        '''
+
+        with open_gzip(self.filename, 'r') as CACHE:
+            for line in CACHE:
+                fields = line.rstrip('\n').split('\t')
+                yield fields[0], fields[1], fields[2], fields[3], fields[4:]
+
+class RedemultiplexJob:
+    '''Reassigns cached reads of a lane to a corrected sample sheet.
+
+    Reads are assigned to samples by index reads, allowing up to
+    'barcode_mismatches' mismatches in each index, as bcl2fastq2 does.
+    Index sequences that match more than one sample are left undetermined.
+    The intermediate is streamed twice. The first pass compares every read's
+    assignment under the corrected sample sheet with the sample bcl2fastq2
+    assigned it to, which is stored in the intermediate. The second pass 
+    writes fastqs only for samples that gained or lost reads, and for 
+    renamed or added samples.
+
+    Args:
+        cache (UndemultiplexedCache): Intermediate of the lane's reads.
+        manifest (dict): Demultiplexing settings of the original run.
+        barcode_sample_dict (dict): Corrected barcode:sample_id.
+        sample_ids (list): Corrected sample IDs in sample sheet order.
+        barcode_mismatches (int): Mismatches allowed in each index.
+        lane_index (int): Index of Illumina flowcell lane (1-8).
+
+    Attributes:
+        cache (UndemultiplexedCache): Intermediate of the lane's reads.
+        manifest (dict): Demultiplexing settings of the original run.
+        barcode_sample_dict (dict): Corrected barcode:sample_id.
+        sample_ids (list): Corrected sample IDs in sample sheet order.
+        barcode_mismatches (int): Mismatches allowed in each index.
+        lane_index (int): Index of Illumina flowcell lane (1-8).
+
+    '''
+
+    UNDETERMINED = 'Undetermined'
+
+    def __init__(self, cache, manifest, barcode_sample_dict, sample_ids, 
+                 barcode_mismatches, lane_index):
+
+        self.cache = cache
+        self.manifest = manifest
+        self.barcode_sample_dict = barcode_sample_dict
+        self.sample_ids = sample_ids
+        self.barcode_mismatches = barcode_mismatches
+        self.lane_index = lane_index
+
+    def _get_cached_index_lengths(self):
+        '''Get index cycles of each cached index read from the bases mask.
+
+        Returns:
+            list: Number of index cycles of each index read; None for reads
+                  whose length is not given in the mask.
+
+        '''
+
+        index_lengths = []
+        for element in (self.manifest.get('use_bases_mask') or '').split(','):
+            if not 'I' in element.upper():
+                continue
+            cycles = re.findall(r'[Ii](\d*)', element)
+            if all(cycles):
+                index_lengths.append(sum(int(length) for length in cycles))
+            else:
+                index_lengths.append(None)
+        return index_lengths
+
+    def _check_barcodes(self):
+        '''Check corrected barcodes can be assigned from the cached index reads.
+
+        Barcodes must all have the same number of indexes, no more than the 
+        cached index reads, and each index must have one length that is not
+        longer than the cached index cycles. No two samples may have barcodes
+        that both match a read within the allowed mismatches.
+
+        '''
+
+        if not self.barcode_sample_dict:
+            return
+
+        index_read_count = self.manifest['index_read_count']
+        barcodes = sorted(self.barcode_sample_dict.keys())
+        index_counts = {len(barcode.split('-')) for barcode in barcodes}
+        if len(index_counts) != 1:
+            logger.error('Barcodes have different numbers of indexes: {}'.format(barcodes))
+            sys.exit(1)
+        index_count = index_counts.pop()
+        if index_count > index_read_count:
+            logger.error(
+                         'Barcodes have {} indexes; the '.format(index_count) +
+                         'undemultiplexed reads only have {} index reads. '.format(index_read_count) +
+                         'Use the original conversion for this barcodes file.')
+            sys.exit(1)
+
+        cached_lengths = self._get_cached_index_lengths()
+        for number in range(index_count):
+            index_lengths = {len(barcode.split('-')[number]) for barcode in barcodes}
+            if len(index_lengths) != 1:
+                logger.error('Index {} of barcodes has different lengths: {}'.format(
+                                                                                   number + 1,
+                                                                                   sorted(index_lengths)))
+                sys.exit(1)
+            index_length = index_lengths.pop()
+            if (number < len(cached_lengths) and cached_lengths[number] and
+                index_length > cached_lengths[number]):
+                logger.error(
+                             'Index {} of barcodes has {} bases; '.format(number + 1, index_length) +
+                             'only {} were cached with '.format(cached_lengths[number]) +
+                             '--use-bases-mask {}'.format(self.manifest['use_bases_mask']))
+                sys.exit(1)
+
+        # Reads within the allowed mismatches of two samples' barcodes
+        for barcode, other_barcode in itertools.combinations(barcodes, 2):
+            if ((self.barcode_sample_dict[barcode] or barcode) == 
+                (self.barcode_sample_dict[other_barcode] or other_barcode)):
+                continue
+            distances = [
+                         sum(base != other_base for base, other_base in zip(index, other_index))
+                         for index, other_index in zip(barcode.split('-'), other_barcode.split('-'))
+                        ]
+            if all(distance <= 2 * self.barcode_mismatches for distance in distances):
+                logger.error(
+                             'Barcodes {} and {} collide with '.format(barcode, other_barcode) +
+                             '{} mismatches allowed; '.format(self.barcode_mismatches) +
+                             'set barcode_mismatches lower.')
+                sys.exit(1)
+
+    def _get_mismatch_variants(self, index):
+        '''Get all sequences within allowed mismatches of an index.
+
+        Args:
+            index (str): Index sequence.
+
+        Returns:
+            set: Index sequences with up to 'barcode_mismatches' mismatches.
+
+        '''
+
+        variants = set([index])
+        for mismatches in range(1, self.barcode_mismatches + 1):
+            for positions in itertools.combinations(range(len(index)), mismatches):
+                for bases in itertools.product('ACGTN', repeat=mismatches):
+                    variant = list(index)
+                    for position, base in zip(positions, bases):
+                        variant[position] = base
+                    variants.add(''.join(variant))
+        return variants
+
+    def _build_assigner(self, barcode_sample_dict):
+        '''Build function assigning index reads to samples of a sample sheet.
+
+        Args:
+            barcode_sample_dict (dict): Barcode:sample_id; sample_id may be
+                                        None, in which case barcode is used.
+
+        Returns:
+            function: Maps cached index reads to a sample_id.
+
+        '''
+
+        if not barcode_sample_dict:
+            return lambda index_reads: self.UNDETERMINED
+
+        barcode_samples = {
+                           barcode : sample_id or barcode
+                           for barcode, sample_id in barcode_sample_dict.items()
+                          }
+        index_count = min(len(barcode.split('-')) for barcode in barcode_samples)
+        index_lengths = [
+                         len(barcode_samples.keys()[0].split('-')[number])
+                         for number in range(index_count)
+                        ]
+
+        # One lookup per index: sequence variant => barcodes it matches
+        lookups = [{} for number in range(index_count)]
+        for barcode in barcode_samples:
+            for number, index in enumerate(barcode.split('-')[:index_count]):
+                for variant in self._get_mismatch_variants(index):
+                    lookups[number].setdefault(variant, set()).add(barcode)
+
+        def assign(index_reads):
+            index_sequences = index_reads.split('+')
+            matches = None
+            for number in range(index_count):
+                sequence = index_sequences[number][:index_lengths[number]]
+                barcodes = lookups[number].get(sequence)
+                if not barcodes:
+                    return self.UNDETERMINED
+                matches = barcodes if matches is None else matches & barcodes
+            if len(matches) != 1:
+                return self.UNDETERMINED
+            return barcode_samples[next(iter(matches))]
+        return assign
+
+    def _get_fastq_prefix(self, output_dir, sample_id, sample_number):
+        '''Get bcl2fastq2-style fastq path prefix of a sample.'''
+
+        return get_fastq_prefix(output_dir, sample_id, sample_number, self.lane_index)
+
+    def run(self, output_dir):
+        '''Write fastqs of samples whose reads changed.
+
+        Args:
+            output_dir (str): Directory to write fastqs to.
+
+        Returns:
+            dict: Changed & removed samples, and read counts under the 
+                  corrected sheet.
+
+        '''
+
+        self._check_barcodes()
+        assign_corrected = self._build_assigner(self.barcode_sample_dict)
+
+        # First pass: find samples affected by the corrected sample sheet
+        changed_samples = set()
+        read_counts = collections.Counter()
+        for index_reads, original_sample, name, comment, read_fields in self.cache.iter_records():
+            corrected_sample = assign_corrected(index_reads)
+            read_counts[corrected_sample] += 1
+            if original_sample != corrected_sample:
+                changed_samples.add(original_sample)
+                changed_samples.add(corrected_sample)
+
+        corrected_samples = set(self.sample_ids)
+        original_samples = set(
+                               sample_id or barcode
+                               for barcode, sample_id in self.manifest['barcode_sample_dict'].items())
+        changed_samples.update(corrected_samples - original_samples)
+        removed_samples = original_samples - corrected_samples
+        changed_samples &= corrected_samples | set([self.UNDETERMINED])
+        logger.info('Samples changed by corrected sample sheet: {}'.format(
+                                                                          sorted(changed_samples)))
+
+        # Second pass: write fastqs of changed samples only
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        sample_numbers = {sample_id : number for number, sample_id in enumerate(self.sample_ids, 1)}
+        sample_numbers[self.UNDETERMINED] = 0
+        writers = {}
+        for sample_id in changed_samples:
+            prefix = self._get_fastq_prefix(output_dir, sample_id, sample_numbers[sample_id])
+            writers[sample_id] = [
+                                  open_gzip('{}_R{}_001.fastq.gz'.format(prefix, number), 'w')
+                                  for number in range(1, self.manifest['output_read_count'] + 1)
+                                 ]
+        if writers:
+            for index_reads, original_sample, name, comment, read_fields in self.cache.iter_records():
+                sample_writers = writers.get(assign_corrected(index_reads))
+                if not sample_writers:
+                    continue
+                for number, writer in enumerate(sample_writers, 1):
+                    # Original header with this read's number, as bcl2fastq2 wrote it
+                    writer.write('@{} {}:{}\n{}\n+\n{}\n'.format(
+                                  name,
+                                  number,
+                                  comment,
+                                  read_fields[2 * number - 2],
+                                  read_fields[2 * number - 1]))
+        for sample_writers in writers.values():
+            for writer in sample_writers:
+                writer.close()
+
+        return {
+                'changed_samples': sorted(changed_samples),
+                'removed_samples': sorted(removed_samples),
+                'read_counts': dict(read_counts)
+               }
+
+class FastqStreamVerifier:
+    '''Checks a gzipped fastq file while it is streamed.
+
+    Computes the MD5 of the compressed bytes, counts reads & bases, and
+    validates the gzip stream in a single pass over the file, so fastqs do
+    not have to be read again after they are uploaded. Fastqs may be made of
+    multiple gzip members. zlib checks the CRC of every member that ends; a
+    truncated file is detected by comparing the trailer at the end of the
+    file with the CRC & size of the data in the last member.
+
+    Attributes:
+        md5 (hashlib.md5): MD5 of compressed bytes read so far.
+        compressed_size (int): Number of compressed bytes read so far.
+        line_count (int): Number of complete fastq lines read so far.
+        base_count (int): Number of sequence bases read so far.
+
+    '''
+
+    def __init__(self):
+
+        self.md5 = hashlib.md5()
+        self.compressed_size = 0
+        self.line_count = 0
+        self.base_count = 0
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._member_crc = 0
+        self._member_size = 0
+        self._trailer = ''
+        self._partial_line = ''
+
+    def update(self, chunk):
+        '''Check the next chunk of compressed fastq data.
+
+        Args:
+            chunk (str): Bytes read from the gzipped fastq file.
+
+        Returns:
+            str: Decompressed data of the chunk.
+
+        Raises:
+            ValueError: If the gzip stream or fastq records are corrupt.
+
+        '''
+
+        self.md5.update(chunk)
+        self.compressed_size += len(chunk)
+        self._trailer = (self._trailer + chunk)[-8:]
+
+        outputs = []
+        data = chunk
+        while data:
+            try:
+                output = self._decompressor.decompress(data)
+            except zlib.error as error:
+                raise ValueError('corrupt gzip stream: {}'.format(error))
+            self._member_crc = zlib.crc32(output, self._member_crc)
+            self._member_size += len(output)
+            self._count_lines(output)
+            outputs.append(output)
+
+            # Data left over after the end of a gzip member is the next member
+            data = self._decompressor.unused_data
+            if data:
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                self._member_crc = 0
+                self._member_size = 0
+        return ''.join(outputs)
+
+    def finish(self):
+        '''Check the end of the fastq file & report its statistics.
+
+        Returns:
+            dict: MD5, read count & base count of the fastq file.
+
+        Raises:
+            ValueError: If the file is truncated.
+
+        '''
+
+        if len(self._trailer) < 8:
+            raise ValueError('file is truncated: no gzip trailer')
+        crc, size = struct.unpack('<II', self._trailer)
+        if (crc != self._member_crc & 0xffffffff
+            or size != self._member_size & 0xffffffff):
+            raise ValueError('file is truncated: gzip trailer does not match data')
+        if self._partial_line or self.line_count % 4:
+            raise ValueError('file is truncated: incomplete fastq record')
+
+        return {
+                'md5': self.md5.hexdigest(),
+                'read_count': self.line_count // 4,
+                'base_count': self.base_count
+               }
+
+    def _count_lines(self, output):
+        '''Count reads & bases in decompressed fastq data.'''
+
+        lines = (self._partial_line + output).split('\n')
+        self._partial_line = lines.pop()
+
+        # Fastq records are 4 lines: header, sequence, separator, qualities
+        headers = lines[-self.line_count % 4::4]
+        sequences = lines[(1 - self.line_count) % 4::4]
+        if not all(header.startswith('@') for header in headers):
+            raise ValueError('malformed fastq record near read {}'.format(
+                                                        self.line_count // 4))
+        self.base_count += sum(len(sequence) for sequence in sequences)
+        self.line_count += len(lines)
+
+class Bcl2fastqFileUploader:
+    '''Upload bcl2fastq2 output files.
+
+    Upload resulting fastq files as well as intermediate and accessory files.
+
+    Every uploaded file is also added to a local DeliveredFileIndex. Quality
+    scores of fastqs are optionally binned as they are uploaded.
+
+    Args:
+        project_dxid (str): ID of project where files will be uploaded.
+        project_path (str): Folder path where files will be uploaded. 
+        quality_binning (str): Name of scheme in QUALITY_BINNING_SCHEMES, or
+                               None to upload quality scores unchanged.
+
+    Attributes:
+        project_dxid (str): ID of project where files will be uploaded.
+        project_path (str): Folder path where files will be uploaded.
+        quality_binning (str): Name of quality binning scheme, or None.
+        file_index (DeliveredFileIndex): Index of uploaded files.
+
+    '''
+
+    def __init__(self, project_dxid, project_path, quality_binning=None):
+
+        self.project_dxid = project_dxid
+        self.project_path = project_path
+        self.quality_binning = quality_binning
+        self.file_index = DeliveredFileIndex(FILE_INDEX_DB)
+
+    def upload_fastq_files(self, raw_properties, tags):
+        '''Recursively find and upload all fastqs to DNAnexus object store.
+
+        Each fastq is checked as it is uploaded, and its MD5, read count and
+        base count are added to its properties. If quality binning is set,
+        the scheme & size reduction are added to its properties as well.
+
+        Args:
+            raw_properties (dict): Properties with values of different types.
+            tags (list): List of descriptive tags.
+
+        Returns:
+            list: DXLinks to all uploaded fastq files.
+        
+        '''
+
+        fastq_dxlinks = []
+        for fastq in self._find_fastqs():
+            fastq_metadata = self._get_scgpm_fastq_name(
+                                                        fastq, 
+                                                        raw_properties['flowcell_id'], 
+                                                        raw_properties['library_name'], 
+                                                        raw_properties['lane_index'])
+            scgpm_name = fastq_metadata[0] 
+            barcode = fastq_metadata[1]
+            read_index = fastq_metadata[2]
+            
+            # Convert all property values to strings
+            properties = {key : str(value) for key, value in raw_properties.items()}
+            properties['barcode'] = barcode
+            properties['read_index'] = read_index
+            properties['file_type'] = 'fastq'
+
+            project_folder = '{}/fastqs'.format(self.project_path)
+            fastq_dxid = self._upload_verified_fastq(
+                                                     local_file_path = fastq,
+                                                     name = scgpm_name,
+                                                     properties = properties,
+                                                     tags = tags,
+                                                     folder = project_folder)
+            fastq_dxlink = dxpy.dxlink(fastq_dxid)
+            fastq_dxlinks.append(fastq_dxlink)
+        return fastq_dxlinks
+
+    def _upload_verified_fastq(self, local_file_path, name, properties, tags, folder):
+        '''Stream fastq to DNAnexus while checking its integrity.
+
+        Args:
+            local_file_path (str): Local path of gzipped fastq file.
+            name (str): Name of uploaded file.
+            properties (dict): Properties with string values.
+            tags (list): List of descriptive tags.
+            folder (str): Folder path where file will be uploaded.
+
+        Returns:
+            str: DNAnexus ID of uploaded fastq file.
+
+        '''
+
+        dx_file = dxpy.new_dxfile(
+                                  name = name,
+                                  properties = properties,
+                                  tags = tags,
+                                  project = self.project_dxid,
+                                  folder = folder,
+                                  parents = True)
+        verifier = FastqStreamVerifier()
+        source_verifier = FastqStreamVerifier()
+        uploaded = False
+        try:
+            if self.quality_binning:
+                chunks = iter_binned_fastq(
+                                           fastq_path = local_file_path, 
+                                           scheme = self.quality_binning,
+                                           verifier = source_verifier)
+                try:
+                    for chunk in chunks:
+                        verifier.update(chunk)
+                        dx_file.write(chunk)
+                finally:
+                    chunks.close()
+            else:
+                with open(local_file_path, 'rb') as FASTQ:
+                    for chunk in iter(lambda: FASTQ.read(UPLOAD_CHUNK_SIZE), ''):
+                        verifier.update(chunk)
+                        dx_file.write(chunk)
+            if self.quality_binning:
+                source_stats = source_verifier.finish()
+            fastq_stats = verifier.finish()
+
+            if self.quality_binning:
+                # Binning must not change the reads of the source fastq
+                if (source_stats['read_count'] != fastq_stats['read_count'] or
+                    source_stats['base_count'] != fastq_stats['base_count']):
+                    raise ValueError('binned fastq has {} reads & {} bases; '.format(
+                                                                        fastq_stats['read_count'],
+                                                                        fastq_stats['base_count']) +
+                                     'source has {} reads & {} bases'.format(
+                                                                        source_stats['read_count'],
+                                                                        source_stats['base_count']))
+                original_size = os.path.getsize(local_file_path)
+                fastq_stats['original_md5'] = source_stats['md5']
+                fastq_stats['quality_binning'] = self.quality_binning
+                fastq_stats['original_size'] = original_size
+                fastq_stats['size_reduction'] = round(
+                                                      1 - float(verifier.compressed_size) / original_size, 4)
+            logger.info('Verified fastq {}: {}'.format(local_file_path, fastq_stats))
+            fastq_properties = {key : str(value) for key, value in fastq_stats.items()}
+            dx_file.set_properties(fastq_properties)
+            dx_file.close()
+            uploaded = True
+        except ValueError as error:
+            logger.error('Fastq {} failed integrity check: {}'.format(
+                                                                      local_file_path,
+                                                                      error))
+            raise Exception('Fastq {} failed integrity check: {}'.format(
+                                                                         local_file_path,
+                                                                         error))
+        finally:
+            # Never leave a partial upload in the project
+            if not uploaded:
+                logger.error('Removing partial upload of fastq {}'.format(local_file_path))
+                dx_file.remove()
+
+        properties = dict(properties)
+        properties.update(fastq_properties)
+        self._index_file(dx_file.get_id(), folder, name, properties, tags)
+        return dx_file.get_id()
+
+    def _index_file(self, dxid, folder, name, properties, tags):
+        '''Add uploaded file to local file index.
+
+        Args:
+            dxid (str): DNAnexus ID of uploaded file.
+            folder (str): Folder path of uploaded file.
+            name (str): Name of uploaded file.
+            properties (dict): Properties with string values.
+            tags (list): List of descriptive tags.
+
+        '''
+
+        self.file_index.add_file(
+                                 dxid = dxid,
+                                 project = self.project_dxid,
+                                 folder = folder,
+                                 name = name,
+                                 properties = properties,
+                                 tags = tags)
+
+    def upload_sample_sheet(self, local_file_path, raw_properties):
+        '''Upload sample sheet to DNAnexus project.
+
+        Args:
+            local_file_path (str): Local path of sample sheet.
+            raw_properties (dict): Properties with values of different types.
+
+        Returns:
+            str: DXLink to sample sheet on DNAnexus object store.
+
+        '''
+
+        # Convert all property values to strings
+        properties = {key : str(value) for key, value in raw_properties.items()}
+        properties['file_type'] = 'sample_sheet'
 
         project_folder = '{}/miscellany'.format(self.project_path)
         sample_sheet_dxid = dxpy.upload_local_file(
@@ -588,6 +2940,12 @@ class Bcl2fastqFileUploader:
                                                    project = self.project_dxid, 
                                                    folder = project_folder, 
                                                    parents = True)
+        self._index_file(
+                         sample_sheet_dxid.get_id(), 
+                         project_folder, 
+                         os.path.basename(local_file_path), 
+                         properties, 
+                         [])
         return dxpy.dxlink(sample_sheet_dxid)
 
     def upload_lane_html(self, raw_properties, tags):
@@ -622,6 +2980,12 @@ class Bcl2fastqFileUploader:
                                                 project = self.project_dxid, 
                                                 folder = project_folder, 
                                                 parents = True)
+        self._index_file(
+                         lane_html_dxid.get_id(), 
+                         project_folder, 
+                         remote_file_name, 
+                         properties, 
+                         tags)
         return dxpy.dxlink(lane_html_dxid)
 
     def upload_tools_used(self, tools_used_dict, raw_properties):
@@ -653,8 +3017,196 @@ class Bcl2fastqFileUploader:
                                                  project = self.project_dxid, 
                                                  folder = project_folder, 
                                                  parents = True)
+        self._index_file(
+                         tools_used_dxid.get_id(), 
+                         project_folder, 
+                         os.path.basename(local_file_path), 
+                         properties, 
+                         [])
         return dxpy.dxlink(tools_used_dxid)
 
+    def upload_undemultiplexed(self, local_file_path, manifest, raw_properties, tags):
+        '''Upload undemultiplexed reads intermediate to DNAnexus project.
+
+        Args:
+            local_file_path (str): Local path of intermediate.
+            manifest (dict): Demultiplexing settings, stored as file details.
+            raw_properties (dict): Properties with values of different types.
+            tags (list): List of descriptive tags.
+
+        Returns:
+            str: DXLink to intermediate on DNAnexus object store.
+
+        '''
+
+        # Convert all property values to strings
+        properties = {key : str(value) for key, value in raw_properties.items()}
+        properties['file_type'] = 'undemultiplexed'
+
+        project_folder = '{}/undemultiplexed'.format(self.project_path)
+        undemultiplexed_dxid = dxpy.upload_local_file(
+                                                      filename = local_file_path,
+                                                      details = manifest,
+                                                      properties = properties,
+                                                      tags = tags,
+                                                      project = self.project_dxid,
+                                                      folder = project_folder,
+                                                      parents = True)
+        self._index_file(
+                         undemultiplexed_dxid.get_id(), 
+                         project_folder, 
+                         os.path.basename(local_file_path), 
+                         properties, 
+                         tags)
+        return dxpy.dxlink(undemultiplexed_dxid)
+
+    def supersede_fastqs(self, folder, sample_ids, raw_properties, current_fastqs):
+        '''Tag earlier fastqs of samples that were regenerated or removed.
+
+        Fastqs of the same run & lane anywhere under 'folder', including 
+        those of earlier re-demultiplexing, are tagged "superseded" and get
+        a "superseded_by" property with the folder of the current fastqs.
+        The same tag & property are recorded for them in the local index, if
+        they were carried forward by carry_forward_file_index().
+
+        Args:
+            folder (str): Project folder searched recursively for fastqs.
+            sample_ids (list): Samples whose earlier fastqs are superseded.
+            raw_properties (dict): Properties of the current fastqs.
+            current_fastqs (list): DXLinks to current fastqs; never tagged.
+
+        Returns:
+            list: DNAnexus IDs of superseded fastqs.
+
+        '''
+
+        barcodes = set()
+        for sample_id in sample_ids:
+            fastq_name = '{}_R1_001.fastq.gz'.format(get_fastq_prefix(
+                                                                     '', 
+                                                                     sample_id, 
+                                                                     0, 
+                                                                     raw_properties['lane_index']))
+            barcodes.add(self._get_scgpm_fastq_name(
+                                                    fastq_name, 
+                                                    raw_properties['flowcell_id'], 
+                                                    raw_properties['library_name'], 
+                                                    raw_properties['lane_index'])[1])
+        current_dxids = {dxlink['$dnanexus_link'] for dxlink in current_fastqs}
+
+        superseded_dxids = []
+        for result in dxpy.find_data_objects(
+                                             classname = 'file',
+                                             project = self.project_dxid,
+                                             folder = folder,
+                                             recurse = True,
+                                             name = '*.fastq.gz',
+                                             name_mode = 'glob',
+                                             properties = {
+                                                           'run_name': str(raw_properties['run_name']),
+                                                           'lane_index': str(raw_properties['lane_index'])
+                                                          },
+                                             describe = {'fields': {'properties': True, 'tags': True}}):
+            description = result['describe']
+            if (result['id'] in current_dxids or 
+                'superseded' in description['tags'] or
+                description['properties'].get('barcode') not in barcodes):
+                continue
+            superseded_properties = {'superseded_by': '{}/fastqs'.format(self.project_path)}
+            dx_file = dxpy.DXFile(result['id'], project = self.project_dxid)
+            dx_file.add_tags(['superseded'])
+            dx_file.set_properties(superseded_properties)
+            self.file_index.add_tags(result['id'], ['superseded'])
+            self.file_index.set_properties(result['id'], superseded_properties)
+            superseded_dxids.append(result['id'])
+        logger.info('Tagged {} fastqs as superseded: {}'.format(
+                                                               len(superseded_dxids),
+                                                               superseded_dxids))
+        return superseded_dxids
+
+    def carry_forward_file_index(self, folder, raw_properties):
+        '''Add the files of the latest earlier index of a run & lane.
+
+        Used when re-demultiplexing, so the new index describes the whole 
+        delivery of the lane rather than only the regenerated files.
+
+        Args:
+            folder (str): Project folder searched recursively for indexes.
+            raw_properties (dict): Properties with run_name & lane_index.
+
+        Returns:
+            str: DNAnexus ID of the earlier index; None if there is none.
+
+        '''
+
+        results = list(dxpy.find_data_objects(
+                                              classname = 'file',
+                                              project = self.project_dxid,
+                                              folder = folder,
+                                              recurse = True,
+                                              name = '*.files.sqlite',
+                                              name_mode = 'glob',
+                                              properties = {
+                                                            'file_type': 'file_index',
+                                                            'run_name': str(raw_properties['run_name']),
+                                                            'lane_index': str(raw_properties['lane_index'])
+                                                           },
+                                              describe = {'fields': {'created': True}}))
+        if not results:
+            logger.warning('No earlier file index of {} lane {}; '.format(
+                                                                        raw_properties['run_name'],
+                                                                        raw_properties['lane_index']) +
+                           'new index only lists files uploaded by this run')
+            return None
+
+        # An earlier re-demultiplexing already carried the original forward
+        latest = max(results, key=lambda result: result['describe']['created'])
+        logger.info('Carrying forward file index: {}'.format(latest['id']))
+        local_file_path = download_file(latest['id'])
+        self.file_index.add_index(local_file_path)
+        os.remove(local_file_path)
+        return latest['id']
+
+    def upload_file_index(self, raw_properties, tags, supersedes=None):
+        '''Upload SQLite index of delivered files to DNAnexus project.
+
+        Should be called after all other files have been uploaded.
+
+        Args:
+            raw_properties (dict): Properties with values of different types.
+            tags (list): List of descriptive tags.
+            supersedes (str): Optional; DNAnexus ID of an earlier index the 
+                              uploaded one replaces, which is then tagged 
+                              "superseded".
+
+        Returns:
+            str: DXLink to file index on DNAnexus object store.
+
+        '''
+
+        # Convert all property values to strings
+        properties = {key : str(value) for key, value in raw_properties.items()}
+        properties['file_type'] = 'file_index'
+
+        self.file_index.close()
+        project_folder = '{}/miscellany'.format(self.project_path)
+        remote_file_name = '{}_L{}.files.sqlite'.format(
+                                                        properties['run_name'],
+                                                        properties['lane_index'])
+        file_index_dxid = dxpy.upload_local_file(
+                                                 filename = FILE_INDEX_DB,
+                                                 name = remote_file_name,
+                                                 properties = properties,
+                                                 tags = tags,
+                                                 project = self.project_dxid,
+                                                 folder = project_folder,
+                                                 parents = True)
+        if supersedes:
+            earlier_index = dxpy.DXFile(supersedes, project = self.project_dxid)
+            earlier_index.add_tags(['superseded'])
+            earlier_index.set_properties({'superseded_by': project_folder})
+        return dxpy.dxlink(file_index_dxid)
+
     def _find_fastqs(self):
         '''Recursively find all fastq files in directory path.
 
@@ -737,6 +3289,10 @@ def main(**applet_inputs):
 
     '''
 
+    # Reassign cached reads instead of converting bcl files again
+    if 'undemultiplexed_file' in applet_inputs.keys():
+        return redemultiplex(**applet_inputs)
+
     # Define all variables here
     global logger
     logger = configure_logger(name = 'RunBcl2fastq2', file_handle = True)
@@ -752,6 +3308,15 @@ def main(**applet_inputs):
     flags_dict = parsed_inputs[3]
     tags = parsed_inputs[4]
 
+    # Archives are only optional when re-demultiplexing cached reads
+    if not ('lane_data_tar' in applet_args.keys() and 'metadata_tar' in applet_args.keys()):
+        logger.error('lane_data_tar and metadata_tar are required ' +
+                     'unless undemultiplexed_file is given')
+        sys.exit(1)
+
+    # bcl2fastq2 default; recorded with the undemultiplexed reads
+    options_dict.setdefault('barcode_mismatches', 1)
+
     # Determines whether or not to create sample sheet, use bases mask.
     if not 'barcodes_file' in applet_args.keys():
         barcodes = False
@@ -772,9 +3337,16 @@ def main(**applet_inputs):
         logger.info('No barcodes associated with this sample')
 
     # Create upload & bcl2fastq runner objects
+    quality_binning = applet_args.get('quality_binning')
+    if quality_binning:
+        tools_used_dict['quality_binning'] = {
+                                              'scheme': quality_binning,
+                                              'bins': QUALITY_BINNING_SCHEMES[quality_binning]
+                                             }
     uploader = Bcl2fastqFileUploader(
                                      applet_args['project_dxid'], 
-                                     applet_args['project_folder'])
+                                     applet_args['project_folder'],
+                                     quality_binning = quality_binning)
     bcl_job = Bcl2fastqJob(
                            run_name = sample_args['run_name'], 
                            lane_index = sample_args['lane_index'])
@@ -788,8 +3360,28 @@ def main(**applet_inputs):
     else:
         logger.info('Skipping sample sheet generation; no barcodes.')
     
-    # Parse use-bases-mask from RunInfo.xml and samplesheet barcodes
-    if not 'use_bases_mask' in options_dict.keys() and barcodes:
+    # Parse use-bases-mask from RunInfo.xml and read structure or barcodes
+    umi_rewriter = None
+    if 'read_structure' in sample_args.keys():
+        if 'use_bases_mask' in options_dict.keys():
+            logger.warning('Read structure overrides --use-bases-mask {}'.format(
+                                                            options_dict['use_bases_mask']))
+        logger.info('Generating use-bases-mask from read structure')
+        bcl2fastq_version = get_bcl2fastq_version()
+        umi_in_mask = bool(bcl2fastq_version and bcl2fastq_version >= BCL2FASTQ_UMI_VERSION)
+        if not umi_in_mask:
+            logger.warning('bcl2fastq2 {} does not support UMIs in '.format(bcl2fastq_version) +
+                           '--use-bases-mask; rewriting fastqs as they are written')
+        base_mask_job = GetUseBasesMaskJob()
+        use_bases_mask, output_reads = base_mask_job.run_read_structure(
+                                            read_structure = sample_args['read_structure'],
+                                            run_info_file = 'RunInfo.xml',
+                                            umi_in_mask = umi_in_mask)
+        options_dict['use_bases_mask'] = use_bases_mask
+        if output_reads and UmiFastqRewriter(output_reads).needs_rewrite():
+            umi_rewriter = UmiFastqRewriter(output_reads)
+
+    elif not 'use_bases_mask' in options_dict.keys() and barcodes:
         logger.info('Inferring use-bases-mask from barcodes')
         base_mask_job = GetUseBasesMaskJob()
         use_bases_mask = base_mask_job.run(
@@ -799,12 +3391,74 @@ def main(**applet_inputs):
         
     else:
         logger.info('Not generating bases mask.')
+
+    # Index read fastqs are needed to cache undemultiplexed reads; only 
+    # bcl2fastq2 sees the forced flag, fastq properties keep the user's flags
+    bcl2fastq_flags = dict(flags_dict)
+    remove_index_fastqs = False
+    if applet_args.get('keep_undemultiplexed') and barcodes:
+        if not 'create_fastq_for_index_reads' in flags_dict.keys():
+            bcl2fastq_flags['create_fastq_for_index_reads'] = True
+            remove_index_fastqs = True
+
+    # Check demultiplexing on a sample of tiles before the full conversion
+    if applet_args.get('smoke_test') and not 'tiles' in options_dict.keys():
+        logger.info('Running smoke test')
+        smoke_job = Bcl2fastqSmokeTestJob(
+                                          tile_count = applet_args.get('smoke_test_tiles', 8),
+                                          max_undetermined = applet_args.get(
+                                                                'smoke_test_max_undetermined', 0.5))
+        tools_used_dict['smoke_test'] = smoke_job.run(
+                                                      bcl_job = bcl_job,
+                                                      tools_used_dict = tools_used_dict,
+                                                      options_dict = options_dict,
+                                                      flags_dict = bcl2fastq_flags,
+                                                      barcode_sample_dict = (
+                                                                             barcode_sample_dict
+                                                                             if barcodes else None),
+                                                      read_structure = sample_args.get('read_structure'))
     
+    # Older bcl2fastq2 versions: move UMIs into read headers as fastqs are written
+    if umi_rewriter:
+        logger.info('Rewriting fastqs with read structure {}'.format(
+                                                                    sample_args['read_structure']))
+        umi_rewriter.start(
+                           output_dir = LOCAL_OUTPUT,
+                           sample_ids = get_sample_sheet_ids(sample_sheet) if barcodes else [],
+                           lane_index = sample_args['lane_index'])
+
     logger.info('Convert bcl to fastq files')
-    bcl_job.run(
-                tools_used_dict = tools_used_dict,
-                options_dict = options_dict,
-                flags_dict = flags_dict)
+    try:
+        bcl_job.run(
+                    tools_used_dict = tools_used_dict,
+                    options_dict = options_dict,
+                    flags_dict = bcl2fastq_flags)
+    except:
+        if umi_rewriter:
+            umi_rewriter.terminate()
+        raise
+    if umi_rewriter:
+        tools_used_dict['umi_extraction'] = umi_rewriter.join()
+
+    # Cache all reads with their index reads for re-demultiplexing
+    if applet_args.get('keep_undemultiplexed'):
+        logger.info('Caching undemultiplexed reads')
+        cache = UndemultiplexedCache('{}_L{}.undemultiplexed.tsv.gz'.format(
+                                                                           sample_args['run_name'],
+                                                                           sample_args['lane_index']))
+        undemultiplexed_manifest = cache.build(
+                                               output_dir = LOCAL_OUTPUT,
+                                               manifest = {
+                                                           'barcode_sample_dict': (
+                                                                                   barcode_sample_dict
+                                                                                   if barcodes else {}),
+                                                           'barcode_mismatches': options_dict['barcode_mismatches'],
+                                                           'use_bases_mask': options_dict.get('use_bases_mask'),
+                                                           'read_structure': sample_args.get('read_structure')
+                                                          },
+                                               sample_ids = get_sample_sheet_ids(sample_sheet) if barcodes else [])
+        if remove_index_fastqs:
+            cache.remove_index_fastqs(LOCAL_OUTPUT)
 
     # Get fastq metadata
     logger.info('Getting fastq metadata') 
@@ -830,6 +3484,135 @@ def main(**applet_inputs):
     output['lane_html'] = uploader.upload_lane_html(
                                                     raw_properties = fastq_properties,
                                                     tags = tags)
+    if applet_args.get('keep_undemultiplexed'):
+        output['undemultiplexed'] = uploader.upload_undemultiplexed(
+                                                                    local_file_path = cache.filename,
+                                                                    manifest = undemultiplexed_manifest,
+                                                                    raw_properties = fastq_properties,
+                                                                    tags = tags)
+    output['file_index'] = uploader.upload_file_index(
+                                                      raw_properties = fastq_properties,
+                                                      tags = tags)
+    return output
+
+@dxpy.entry_point("redemultiplex")
+def redemultiplex(**applet_inputs):
+    '''Regenerate fastqs changed by a corrected barcodes file.
+
+    Reassigns the reads of an undemultiplexed intermediate, created by a 
+    previous run with keep_undemultiplexed, to the samples of the corrected
+    barcodes file. Only fastqs of samples whose reads changed are written &
+    uploaded; lane & metadata archives are not downloaded. Changes are 
+    relative to the samples bcl2fastq2 assigned reads to in the run that
+    created the intermediate. Outputs are uploaded to a "redemultiplexed" 
+    folder and the earlier fastqs they replace are tagged "superseded". The
+    new file index starts from the latest earlier index of the lane, so it
+    also lists the earlier files, with the superseded tags.
+
+    Args:
+        applet_input (dict): Input parameters specified when calling applet 
+                             from DNAnexus.
+
+    Returns:
+        dict: Names of outputs and corresponding file dxids.
+
+    '''
+
+    global logger
+    logger = configure_logger(name = 'RunBcl2fastq2', file_handle = True)
+
+    tools_used_dict = {'name': 'Re-demultiplexing of Cached Reads', 'commands': []}
+    output = {}
+
+    # Parse applet inputs
+    parsed_inputs = parse_applet_inputs(applet_inputs)
+    applet_args = parsed_inputs[0]
+    sample_args = parsed_inputs[1]
+    options_dict = parsed_inputs[2]
+    flags_dict = parsed_inputs[3]
+    tags = parsed_inputs[4]
+
+    if not 'barcodes_file' in applet_args.keys():
+        logger.error('A corrected barcodes file is required to re-demultiplex')
+        sys.exit(1)
+
+    # Download intermediate & corrected barcodes
+    logger.info('Downloading undemultiplexed reads: %s' % applet_args['undemultiplexed_file'])
+    undemultiplexed_dxfile = dxpy.DXFile(applet_args['undemultiplexed_file'])
+    manifest = undemultiplexed_dxfile.get_details()
+    original_properties = undemultiplexed_dxfile.get_properties()
+    cache = UndemultiplexedCache(download_file(applet_args['undemultiplexed_file']))
+    logger.info('Downloading barcodes file: %s' % applet_args['barcodes_file'])
+    barcodes_filename = download_file(applet_args['barcodes_file'])
+
+    quality_binning = applet_args.get('quality_binning')
+    if quality_binning:
+        tools_used_dict['quality_binning'] = {
+                                              'scheme': quality_binning,
+                                              'bins': QUALITY_BINNING_SCHEMES[quality_binning]
+                                             }
+    # Keep regenerated fastqs apart from the fastqs they replace
+    uploader = Bcl2fastqFileUploader(
+                                     applet_args['project_dxid'], 
+                                     '{}/redemultiplexed'.format(applet_args['project_folder']),
+                                     quality_binning = quality_binning)
+    bcl_job = Bcl2fastqJob(
+                           run_name = sample_args['run_name'], 
+                           lane_index = sample_args['lane_index'])
+
+    # New index lists the whole delivery, not only the regenerated files
+    earlier_file_index = uploader.carry_forward_file_index(
+                                                           folder = applet_args['project_folder'],
+                                                           raw_properties = sample_args)
+
+    logger.info('Creating sample sheet')
+    sample_sheet, barcode_sample_dict = bcl_job.create_sample_sheet(barcodes_filename)
+    output['sample_sheet'] = uploader.upload_sample_sheet(sample_sheet, sample_args)
+
+    # Reassign reads & write fastqs of changed samples
+    redemux_job = RedemultiplexJob(
+                                   cache = cache,
+                                   manifest = manifest,
+                                   barcode_sample_dict = barcode_sample_dict,
+                                   sample_ids = get_sample_sheet_ids(sample_sheet),
+                                   barcode_mismatches = options_dict.get(
+                                                            'barcode_mismatches',
+                                                            manifest['barcode_mismatches']),
+                                   lane_index = sample_args['lane_index'])
+    tools_used_dict['redemultiplex'] = redemux_job.run(REDEMUX_OUTPUT)
+    tools_used_dict['redemultiplex']['undemultiplexed_file'] = undemultiplexed_dxfile.get_id()
+
+    # Get fastq metadata from original run
+    sample_args['flowcell_id'] = original_properties['flowcell_id']
+    sample_args['trunc_flowcell_id'] = truncate_flowcell_id(sample_args['flowcell_id'])
+    sample_args['library_name'] = format_library_name(sample_args['library_name'])
+    if manifest.get('read_structure'):
+        sample_args['read_structure'] = manifest['read_structure']
+
+    fastq_properties = {}
+    fastq_properties.update(sample_args)
+    fastq_properties['barcode_mismatches'] = redemux_job.barcode_mismatches
+    fastq_properties['use_bases_mask'] = manifest['use_bases_mask']
+    fastq_properties['redemultiplexed_from'] = undemultiplexed_dxfile.get_id()
+
+    logger.info('Create tools used file')
+    output['tools_used'] = uploader.upload_tools_used(tools_used_dict, fastq_properties)
+
+    logger.info('Uploading regenerated fastq files back to DNAnexus')
+    output['fastqs'] = uploader.upload_fastq_files(
+                                                   raw_properties = fastq_properties,
+                                                   tags = tags)
+    uploader.supersede_fastqs(
+                              folder = applet_args['project_folder'],
+                              sample_ids = (
+                                            tools_used_dict['redemultiplex']['changed_samples'] +
+                                            tools_used_dict['redemultiplex']['removed_samples']),
+                              raw_properties = fastq_properties,
+                              current_fastqs = output['fastqs'])
+    output['file_index'] = uploader.upload_file_index(
+                                                      raw_properties = fastq_properties,
+                                                      tags = tags,
+                                                      supersedes = earlier_file_index)
     return output
 
 dxpy.run()